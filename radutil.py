@@ -28,13 +28,50 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 from __future__ import with_statement
 import re
-from contextlib import closing
+import shlex
+from contextlib import closing, contextmanager
 import sys
 import os
 from subprocess import Popen, call, STDOUT, PIPE
 from sets import Set
 import shutil
 import uuid
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+import tempfile
+import cPickle as pickle
+import json
+import hashlib
+import base64
+import marshal
+import struct
+import fnmatch
+import stat
+import mmap
+import heapq
+import itertools
+import errno
+import time
+import threading
+import functools
+import Queue
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    from os import scandir as _os_scandir
+except ImportError:
+    try:
+        from scandir import scandir as _os_scandir
+    except ImportError:
+        _os_scandir = None
 
 class Config(dict):
     """Example of overloading __getatr__ and __setattr__
@@ -53,6 +90,13 @@ class Config(dict):
             'case_sensitive': False,
             'checksum': 'sha1',
             'fsdiffpath': '.',
+            'cache_dir': '',
+            'checksum_engine': 'native',
+            'processes': '0',
+            'checksum_cache_size': '1000000',
+            'transcript_index': 'manual',
+            'sort_memory': '64',
+            'socket': '',
         }
         configparser = ConfigParser.SafeConfigParser(base_defaults)
         configparser.read(config_paths)
@@ -87,47 +131,403 @@ config = Config()
 def is_load(f):
     return f.lower()[-2:] == '.t'
 
+# instrumentation, functions called with (event, detail) for every event while subscribed
+_listeners = []
+_phase = threading.local()
+
+def subscribe(listener):
+    """
+    calls listener(event, detail) for each I/O event radutil raises
+
+    events are open, read and write (bytes), exists, k_parse, k_write, subprocess
+    (command, seconds, returncode), move (seconds) and phase (seconds, when a phase
+    ends).  detail is a dict that always has the path, or None, and the current phase,
+    a '/' separated list of the phases entered.  Files hashed by worker processes
+    are reported by the calling process
+    """
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+def unsubscribe(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+def current_phase():
+    return getattr(_phase,'name','')
+
+def _emit(event,path=None,**detail):
+    if not _listeners:
+        return
+    detail['path'] = path
+    detail['phase'] = current_phase()
+    for listener in list(_listeners):
+        listener(event,detail)
+
+class phase(object):
+    """
+    context manager naming the work done inside it for subscribers, phases entered
+    inside another are named outer/inner
+
+        with radutil.phase('combine'):
+            ...
+    """
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        self.outer = current_phase()
+        _phase.name = self.outer and '%s/%s' % (self.outer,self.name) or self.name
+        self.start = time.time()
+        return self
+
+    def __exit__(self,*exc):
+        _emit('phase',seconds=time.time() - self.start)
+        _phase.name = self.outer
+        return False
+
+    def __call__(self,func):
+        """used as a decorator, runs each call of func in the phase"""
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with phase(self.name):
+                return func(*args,**kwargs)
+        return wrapper
+
+class _CountingFile(object):
+    """wraps a file, reporting the bytes read and written through it when closed"""
+    def __init__(self,f,path):
+        self.f = f
+        self.path = path
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read(self,*args):
+        data = self.f.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self,*args):
+        line = self.f.readline(*args)
+        self.bytes_read += len(line)
+        return line
+
+    def readlines(self,*args):
+        lines = self.f.readlines(*args)
+        self.bytes_read += sum([len(line) for line in lines])
+        return lines
+
+    def __iter__(self):
+        for line in self.f:
+            self.bytes_read += len(line)
+            yield line
+
+    def write(self,data):
+        self.bytes_written += len(data)
+        self.f.write(data)
+
+    def writelines(self,lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.close()
+        if self.bytes_read:
+            _emit('read',self.path,bytes=self.bytes_read)
+        if self.bytes_written:
+            _emit('write',self.path,bytes=self.bytes_written)
+
+    def __getattr__(self,name):
+        return getattr(self.f,name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+        return False
+
+def _open(path,mode='r'):
+    """open, counted for subscribers"""
+    f = open(path,mode)
+    if not _listeners:
+        return f
+    _emit('open',path,mode=mode)
+    return _CountingFile(f,path)
+
+def _fdopen(fd,mode,path):
+    """os.fdopen of a temp file, counted for subscribers"""
+    f = os.fdopen(fd,mode)
+    if not _listeners:
+        return f
+    _emit('open',path,mode=mode)
+    return _CountingFile(f,path)
+
+def _exists(path):
+    """os.path.exists, counted for subscribers"""
+    if _listeners:
+        _emit('exists',path)
+    return os.path.exists(path)
+
+def _run(cmd,**kwargs):
+    """runs a command with Popen, waiting for it, returns (process, output, error)"""
+    start = time.time()
+    process = Popen(cmd,**kwargs)
+    o,e = process.communicate()
+    _emit('subprocess',cmd[0],command=' '.join(cmd),seconds=time.time() - start,
+        returncode=process.returncode)
+    return process, o, e
+
 def makedirs(p):
     d = os.path.split(p)[0]
-    if not os.path.exists(d):
+    if not _exists(d):
         os.makedirs(d)
 
 def fs_move(old,new):
     makedirs (new)
+    start = time.time()
     os.rename (old,new)
+    _emit('move',old,new=new,seconds=time.time() - start)
+
+class Profiler(object):
+    """
+    collects radutil events into totals per phase
+
+        profiler = Profiler()
+        with profiler:
+            radutil.combine(...)
+        print profiler.format()
+    """
+    counters = ('open','read','write','exists','k_parse','k_write','subprocess','move')
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.start = None
+        self.seconds = 0.0
+        # events arrive from checkin worker threads
+        self.lock = threading.Lock()
+
+    def _phase(self,name):
+        if name not in self.phases:
+            totals = dict([(c,0) for c in self.counters])
+            totals.update({'bytes_read':0,'bytes_written':0,'subprocess_seconds':0.0,
+                'move_seconds':0.0,'seconds':0.0})
+            self.phases[name] = totals
+        return self.phases[name]
+
+    def __call__(self,event,detail):
+        with self.lock:
+            self._add(event,detail)
+
+    def _add(self,event,detail):
+        if event == 'phase':
+            # a phase's own time is reported against it, not the phase it is in
+            self._phase(detail['phase'])['seconds'] += detail['seconds']
+            return
+        totals = self._phase(detail['phase'])
+        totals[event] += 1
+        if event == 'read':
+            totals['bytes_read'] += detail['bytes']
+        elif event == 'write':
+            totals['bytes_written'] += detail['bytes']
+        elif event in ('subprocess','move'):
+            totals[event + '_seconds'] += detail['seconds']
+
+    def __enter__(self):
+        self.start = time.time()
+        subscribe(self)
+        return self
+
+    def __exit__(self,*exc):
+        unsubscribe(self)
+        self.seconds += time.time() - self.start
+        return False
+
+    def report(self):
+        """the totals as a dict, with each phase's totals under phases, '' for work outside any phase"""
+        return {'seconds':self.seconds,'phases':dict(self.phases)}
+
+    def format(self):
+        """the totals as a table"""
+        rows = ['%-28s %8s %6s %10s %10s %6s %5s %5s %10s %10s' % ('phase','seconds','opens',
+            'read','written','exists','K in','K out','subprocess','moves')]
+        for name, t in self.phases.items():
+            rows.append('%-28s %8.3f %6s %10s %10s %6s %5s %5s %4s %4.1fs %4s %4.1fs' % (
+                name or '(other)',t['seconds'],t['open'],prettySize(t['bytes_read']),
+                prettySize(t['bytes_written']),t['exists'],t['k_parse'],t['k_write'],
+                t['subprocess'],t['subprocess_seconds'],t['move'],t['move_seconds']))
+        rows.append('%s seconds in total' % round(self.seconds,3))
+        return '\n'.join(rows)
     
+_k_line_re = re.compile(r'^(\s*(?:-\s+)?)(\S+)(\s+)(\S+)(.*)$',re.S)
+
+def _item_kinds(item):
+    """the command file line types that can reference item"""
+    if item.lower().endswith('.k'):
+        return ('k',)
+    elif item.lower().endswith('.t'):
+        return ('p','n')
+    raise ValueError ("'%s' not a valid radmind file to search" % item)
+
+def _only(k_files):
+    if k_files is None:
+        return None
+    return Set([get_relative_path(k) for k in k_files])
+
+class KBatch(object):
+    """
+    collects rename and remove operations on command files and applies them in one pass
+
+    each affected command file is read once, every queued operation is applied to its
+    parsed lines in the order queued, and the result replaces the file with a temp file
+    and rename, so a crash can not leave a truncated command file
+
+    lines are matched on their parsed path field, so renaming foo.T leaves foo.T2.T alone
+
+    """
+    def __init__(self):
+        self.ops = []
+
+    def rename(self,old,new,only=None):
+        """
+        renames old to new, a new name of '' is an implicit remove
+
+        only optionally limits the operation to a list of command files
+        """
+        if new == '':
+            return self.remove(old,only=only)
+        old = get_relative_path(old)
+        self.ops.append(('rename',[old],get_relative_path(new),_item_kinds(old),_only(only)))
+
+    def remove(self,old,only=None):
+        old = get_relative_path(old)
+        self.ops.append(('remove',[old],None,_item_kinds(old),_only(only)))
+
+    def collapse(self,olds,new):
+        """
+        replaces a group of items with a single new one
+
+        olds are listed highest precedence first.  In each command file the line of the
+        first of olds that the file references is renamed to new, so new takes the place
+        of the highest precedence item, any others are removed.  If new is already
+        referenced all of olds are removed
+
+        """
+        olds = [get_relative_path(old) for old in olds]
+        new = get_relative_path(new)
+        if olds:
+            self.ops.append(('collapse',olds,new,_item_kinds(new),None))
+
+    def items(self):
+        """all names the queued operations look for"""
+        found = Set()
+        for op, olds, new, kinds, only in self.ops:
+            found.update(olds)
+        return found
+
+    def apply(self,lines,k=None):
+        """
+        applies the queued operations to a list of command file lines, returns the new list
+
+        k names the command file the lines came from, for operations limited to some
+        command files
+        """
+        parsed = []
+        for line in lines:
+            m = None
+            if line.strip() and not line.lstrip().startswith('#'):
+                m = _k_line_re.match(line)
+            parsed.append(m and list(m.groups()) or line)
+        for op, olds, new, kinds, only in self.ops:
+            if only is not None and k not in only:
+                continue
+            matching = [p for p in parsed if isinstance(p,list) and p[1] in kinds and p[3] in olds]
+            if not matching:
+                continue
+            drop = Set([id(p) for p in matching])
+            if op == 'remove':
+                parsed = [p for p in parsed if id(p) not in drop]
+            elif op == 'rename':
+                for p in matching:
+                    p[3] = new
+            elif op == 'collapse':
+                present = [p for p in parsed if isinstance(p,list) and p[1] in kinds and p[3] == new]
+                if not present:
+                    # min keeps the first line in the file of the chosen item
+                    first = min(matching,key=lambda p: olds.index(p[3]))
+                    first[3] = new
+                    drop.discard(id(first))
+                parsed = [p for p in parsed if id(p) not in drop]
+        return [isinstance(p,list) and ''.join(p) or p for p in parsed]
+
+    def _changes(self,k_files=None):
+        """
+        yields (command file, full path, lines, new lines) for each affected command file
+
+        k_files names the command files to read, otherwise those the reference index
+        lists for the queued items are opened, along with any an operation is limited
+        to.  The index leaves out command files matching default_k_excludes, so files
+        named are read directly
+        """
+        if k_files is not None:
+            affected = Set([_k_name(k) for k in k_files])
+        else:
+            affected = Set()
+            for op, olds, new, kinds, only in self.ops:
+                if only is not None:
+                    affected.update(only)
+                    continue
+                for old in olds:
+                    affected.update(find_references(old))
+        for k in sorted(affected):
+            k_file = get_full_path(k)
+            with closing(_open(k_file)) as src:
+                lines = src.readlines()
+            yield k, k_file, lines, self.apply(lines,k)
+
+    def preview(self,k_files=None):
+        """the changes commit would make, {command file: (lines, new lines)}, nothing is written"""
+        changes = OrderedDict()
+        for k, k_file, lines, new_lines in self._changes(k_files):
+            if new_lines != lines:
+                changes[k] = (lines,new_lines)
+        return changes
+
+    @phase('commands')
+    def commit(self,k_files=None):
+        """
+        rewrites the affected command files, or only those in k_files
+
+        returns the list of command files modified
+        """
+        modified = []
+        for k, k_file, lines, new_lines in self._changes(k_files):
+            if new_lines != lines:
+                _atomic_write(k_file,''.join(new_lines))
+                _emit('k_write',k_file)
+                _forget_k(k)
+                modified.append(k)
+        return modified
+
 def _rename_or_remove_x_in_k(k,old,new=None,recurse=True,remove=False):
     """internal factored function"""
-    mods_made = False
     if new == '':
         # implicit remove
         remove = True
     if not (remove or new):
         raise ValueError ("No replacement name provided")
-    for this_k, sub_k, these_t, these_e in walk_K(k):
-        if old.lower().endswith('.k'):
-            subs = sub_k
-        elif old.lower().endswith('.t'):
-            subs = these_t
-        else:
-            raise ValueError ("'old' name not a valid radmind file to search")
-        if old in subs:
-            k_file = get_full_path(this_k)
-            f = open(k_file)
-            lines = f.readlines()
-            if remove:
-                lines = [x for x in lines if not old in x]
-            else:
-                lines = [x.replace(old,new) for x in lines]
-            f.close()
-            # reopen file with write permission (seeking to 0 could leave stray bytes at the end)
-            f = open(k_file,'w')
-            f.write(''.join(lines)) # they already have newline
-            mods_made = True
-            
-        if not recurse:
-            return mods_made
-    return mods_made
+    batch = KBatch()
+    if remove:
+        batch.remove(old)
+    else:
+        batch.rename(old,new)
+    # walk_K yields the root as given, the reference index uses names relative to command/
+    if recurse:
+        k_files = [_k_name(this_k) for this_k, sub_k, these_t, these_e in walk_K(k)]
+    else:
+        k_files = [_k_name(k)]
+    return bool(batch.commit(k_files))
     
 def rename_t_in_k(k,t_old,t_new,recurse=True):
     """renames occurrences of t in k or children - changes only K files
@@ -163,7 +563,7 @@ def rename_k_in_k(k,k_old,k_new,recurse=True):
 
     returns true if changes were made
     """
-    return _rename_or_remove_x_in_k(k,k_old,k_new=k_new,recurse=recurse)
+    return _rename_or_remove_x_in_k(k,k_old,new=k_new,recurse=recurse)
 
 def remove_k_in_k(k,k_old,recurse=True):
     """removes occurrences of k in k or children - changes only K files
@@ -176,6 +576,7 @@ def remove_k_in_k(k,k_old,recurse=True):
     return _rename_or_remove_x_in_k(k,k_old,recurse=recurse,remove=True)
 
 
+@phase('rename')
 def rename(t,new_name,update_k=True):
     """moves or renames transcript/command file and any associated file storage
     
@@ -188,6 +589,9 @@ def rename(t,new_name,update_k=True):
     t_file = get_full_path(t)
     new_f = os.path.join(config.rad_dir,'transcript',new_name)
     fs_move (t_file,new_f)
+    if is_load(t):
+        _move_index(t_file,new_f)
+        _path_index_changed([get_relative_path(t),new_name])
     if update_k:
         # update any references to the old name to point to the new name
         swap(t,new_name)
@@ -195,7 +599,7 @@ def rename(t,new_name,update_k=True):
 def init_trash():
     # make trash directories
     def make_if_not_exists(p):
-        if not os.path.exists(p):
+        if not _exists(p):
             os.makedirs(p)
             
     trash_dir = os.path.join(config.rad_dir,'trash')
@@ -208,44 +612,262 @@ def init_trash():
 
 def empty_trash():
     shutil.rmtree(os.path.join(config.rad_dir,'trash'))
+    _trash.pop(_trash_manifest_path(),None)
     init_trash()
 
+# trash manifests by path, [entries by generation, next generation, stat of the manifest]
+_trash = {}
+
+def _trash_manifest_path():
+    return os.path.join(config.rad_dir,'trash','manifest')
+
+def _trash_manifest():
+    """
+    the trash manifest, an append only log of json lines in the trash directory
+
+    each deletion is added as {generation, item, deleted, bytes, paths}, where paths maps
+    the original path of each moved file or directory, relative to rad_dir, to its
+    place in the trash.
+    Restored and purged generations are logged as {generation, removed: true}.  The
+    log is read once per process, and again only if another process appends to it
+    """
+    path = _trash_manifest_path()
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime,st.st_size)
+    except OSError:
+        stamp = None
+    entry = _trash.get(path)
+    if entry is not None and entry[2] == stamp:
+        return entry
+    entries = OrderedDict()
+    next_gen = 1
+    if stamp is not None:
+        with closing(_open(path)) as src:
+            for line in src:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                gen = record['generation']
+                next_gen = max(next_gen,gen + 1)
+                if record.get('removed'):
+                    entries.pop(gen,None)
+                else:
+                    entries[gen] = record
+    entry = _trash[path] = [entries,next_gen,stamp]
+    return entry
+
+def _trash_log(records):
+    """appends records to the trash manifest, keeping the in memory copy current"""
+    entry = _trash_manifest()
+    path = _trash_manifest_path()
+    with closing(_open(path,'a')) as dst:
+        for record in records:
+            dst.write(json.dumps(record,sort_keys=True) + '\n')
+    for record in records:
+        if record.get('removed'):
+            entry[0].pop(record['generation'],None)
+        else:
+            entry[0][record['generation']] = record
+    st = os.stat(path)
+    entry[2] = (st.st_mtime,st.st_size)
+
+def _trash_rewrite(entries):
+    """replaces the trash manifest with only the entries given, dropping its history"""
+    path = _trash_manifest_path()
+    _atomic_write(path,''.join([json.dumps(record,sort_keys=True) + '\n' for record in entries]))
+    _trash.pop(path,None)
+
+def trash_list(item=None):
+    """
+    lists the trash, oldest first, as dicts {generation, item, deleted, bytes, paths}
+
+    deleted is the time of deletion in seconds since the epoch, bytes is the size
+    of the transcript or command file and any stored files.  With an item only its
+    generations are listed
+    """
+    entries = _trash_manifest()[0].values()
+    if item is not None:
+        item = get_relative_path(item)
+        entries = [e for e in entries if e['item'] == item]
+    return list(entries)
+
+def _trash_paths(item,paths,size):
+    """
+    moves full paths below rad_dir into a new trash generation, keeping their path
+    relative to rad_dir, and logs them in the manifest under item
 
+    the generation is claimed by creating its directory, so concurrent deletions,
+    which may read the same manifest, never share one
+
+    returns the generation
+    """
+    entry = _trash_manifest()
+    gen = entry[1]
+    trash_dir = os.path.join(config.rad_dir,'trash')
+    if not _exists(trash_dir):
+        os.makedirs(trash_dir)
+    while True:
+        gen_dir = os.path.join(trash_dir,str(gen))
+        try:
+            os.mkdir(gen_dir)
+        except OSError,e:
+            if e.errno != errno.EEXIST:
+                raise
+            gen += 1
+        else:
+            break
+    entry[1] = max(entry[1],gen + 1)
+    moved = {}
+    for path in paths:
+        rel = os.path.relpath(path,config.rad_dir)
+        fs_move(path,os.path.join(gen_dir,rel))
+        moved[rel] = os.path.relpath(os.path.join(gen_dir,rel),config.rad_dir)
+    _trash_log([{'generation':gen,'item':item,'deleted':time.time(),'bytes':size,'paths':moved}])
+    return gen
+
+@phase('delete')
 def delete(t,update_k=True,multiple_ok=True):
-    """deletes a loadset/command and removes references to it from command files"""
-    init_trash()
-    unique_suffix = ''
-    if is_load(t):
-        f_dir = get_full_path(t,loc='file')
-        new_dir = os.path.join(config.rad_dir,'trash',f_dir.replace(config.rad_dir,''))
-        if os.path.exists(new_dir):
-            if not multiple_ok:
-                raise RuntimeError ("item with that name already in trash")
-            else:
-                while os.path.exists(new_dir):
-                    # @@ this could be substantially improved
-                    new_dir += '_'
-                    unique_suffix += '_'
-        fs_move(f_dir,new_dir)
-    # do this in this order just in case files were not found... unlikely
+    """
+    deletes a loadset/command and removes references to it from command files
+
+    the transcript or command file, and any stored files, are moved into a new trash
+    generation, trash/<generation>/transcript/<t> and trash/<generation>/file/<t>, and
+    recorded in the trash manifest.  If multiple_ok is False an item that is already in
+    the trash raises RuntimeError
+
+    returns the generation
+    """
+    item = get_relative_path(t)
+    if not multiple_ok and trash_list(item):
+        raise RuntimeError ("item with that name already in trash")
     t_file = get_full_path(t)
-    new_f = os.path.join(config.rad_dir,'trash',t_file.replace(config.rad_dir,'')) + unique_suffix
-    fs_move(t_file,new_f)
+    moves = [t_file]
+    size = os.path.getsize(t_file)
+    if is_load(t):
+        # a transcript of only directories and links has no stored files
+        f_dir = get_full_path(t,loc='file',must_exist=False)
+        if _exists(f_dir):
+            moves.insert(0,f_dir)
+        size += _t_totals(t_file)[0]
+    gen = _trash_paths(item,moves,size)
+    if is_load(t):
+        _drop_index(t_file)
+        _path_index_changed([item])
     # @@ clean up empty folders here?
     if update_k:
         # remove any references to the old name
         swap(t,'') 
+    return gen
         
-def undelete(t):
+@phase('undelete')
+def undelete(t,generation=None):
+    """
+    restores a loadset/command from the trash to where it was deleted from
+
+    by default the latest generation of t is restored, or the generation given.
+    Items trashed before the manifest was kept are restored from trash/transcript,
+    trash/file and trash/command.  Raises RuntimeError if the item exists outside the
+    trash
+
+    returns the generation restored, or None for an item from before the manifest
+    """
+    item = get_relative_path(t)
+    entries = trash_list(item)
+    if generation is not None:
+        entries = [e for e in entries if e['generation'] == int(generation)]
+        if not entries:
+            raise ValueError ("generation %s of %s not in trash" % (generation,item))
+    if entries:
+        record = entries[-1]
+        moves = [(os.path.join(config.rad_dir,new),os.path.join(config.rad_dir,path))
+            for path, new in record['paths'].items()]
+    elif generation is None:
+        # trashed before the manifest, relative paths are kept under trash/
+        moves = []
+        f_dir = is_load(t) and get_full_path(t,loc='file',trash=True,must_exist=False)
+        if f_dir and _exists(f_dir):
+            moves.append((f_dir,os.path.join(config.rad_dir,'file',item)))
+        t_file = get_full_path(t,trash=True)
+        kind = is_load(t) and 'transcript' or 'command'
+        moves.append((t_file,os.path.join(config.rad_dir,kind,item)))
+        record = None
+    for old, new in moves:
+        if _exists(new):
+            raise RuntimeError ("%s already exists" % new)
+    for old, new in moves:
+        fs_move(old,new)
+    if record is not None:
+        _trash_log([{'generation':record['generation'],'removed':True}])
+        _remove_empty_dirs(os.path.join(config.rad_dir,'trash',str(record['generation'])))
     if is_load(t):
-        f_dir = get_full_path(t,loc='file',trash=True)
-        new_dir = os.path.join(config.rad_dir,f_dir.replace('trash',''))
-        fs_move(f_dir,new_dir)
-    t_file = get_full_path(t,trash=True)
-    new_f = os.path.join(config.rad_dir,t_file.replace('trash',''))
-    fs_move(t_file,new_f)
+        _path_index_changed([item])
+    return record and record['generation']
+
+def _remove_empty_dirs(top):
+    """removes top and any directories below it that are empty"""
+    for dirpath, dirnames, filenames in os.walk(top,topdown=False):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+
+def _purge_generation(gen_dir):
+    """worker function, removes a trash generation directory"""
+    try:
+        shutil.rmtree(gen_dir)
+    except OSError,e:
+        if e.errno != errno.ENOENT:
+            return (gen_dir,str(e))
+    return (gen_dir,None)
+
+@phase('purge')
+def purge_trash(older_than=None,max_bytes=None,dry_run=False,processes=None):
+    """
+    permanently removes trash generations
+
+    generations deleted more than older_than days ago are purged, then the oldest
+    generations until the trash holds no more than max_bytes.  With neither every
+    generation is purged.  Generations are removed in parallel, dry_run only reports
+
+    returns a dict {purged, bytes, errors}, purged being the manifest entries removed,
+    bytes the space reclaimed and errors a list of (generation, message)
+    """
+    entries = sorted(trash_list(),key=lambda e: e['generation'])
+    if older_than is None and max_bytes is None:
+        purge = entries
+    else:
+        purge = []
+        if older_than is not None:
+            cutoff = time.time() - float(older_than) * 86400
+            purge = [e for e in entries if e['deleted'] < cutoff]
+        if max_bytes is not None:
+            kept = [e for e in entries if e not in purge]
+            total = sum([e['bytes'] for e in kept])
+            for e in kept:
+                if total <= max_bytes:
+                    break
+                purge.append(e)
+                total -= e['bytes']
+    report = {'purged':purge,'bytes':sum([e['bytes'] for e in purge]),'errors':[]}
+    if dry_run or not purge:
+        return report
+    trash_dir = os.path.join(config.rad_dir,'trash')
+    by_dir = dict([(os.path.join(trash_dir,str(e['generation'])),e) for e in purge])
+    failed = Set()
+    for gen_dir, err in _pool_map(_purge_generation,by_dir.keys(),processes):
+        if err is not None:
+            failed.add(by_dir[gen_dir]['generation'])
+            report['errors'].append((by_dir[gen_dir]['generation'],err))
+    purged = Set([e['generation'] for e in purge]) - failed
+    report['purged'] = [e for e in purge if e['generation'] in purged]
+    report['bytes'] = sum([e['bytes'] for e in report['purged']])
+    # purging is when the log is compacted down to the generations still in the trash
+    _trash_rewrite([e for e in entries if e['generation'] not in purged])
+    return report
 
-    
 def remove_load(t):
     """
     remove all references to a transcript - change only command files
@@ -262,12 +884,95 @@ def swap(old,new):
     """
     replace all occurrences of old with new in all command files
     """
-    mods_made = False
-    for k in all_k():
-        r = _rename_or_remove_x_in_k(k,old,new,recurse=False)
-        mods_made = mods_made or r
-    return mods_made
+    batch = KBatch()
+    batch.rename(old,new)
+    return bool(batch.commit())
+
+# verb: (minimum, maximum) number of arguments
+_batch_verbs = {
+    'rename':(2,2),
+    'remove':(1,2),
+    'delete':(1,1),
+    'undelete':(1,2),
+    'swap':(2,2),
+}
+
+def parse_batch(lines):
+    """
+    parses batch lines of the form verb arg [arg], one step per line
+
+    blank lines and lines starting with # are skipped, arguments are split as in a shell.
+    Returns a list of (line number, verb, args), raising ValueError for any line that
+    is not a valid step so nothing is run from a bad batch
+    """
+    steps = []
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        args = shlex.split(line)
+        verb = args.pop(0)
+        if verb not in _batch_verbs:
+            raise ValueError ("line %s: '%s' can not be batched" % (i + 1,verb))
+        low, high = _batch_verbs[verb]
+        if not low <= len(args) <= high:
+            raise ValueError ("line %s: wrong number of arguments for %s" % (i + 1,verb))
+        steps.append((i + 1,verb,args))
+    return steps
+
+@phase('batch')
+def run_batch(steps,continue_on_error=False):
+    """
+    runs a list of (line number, verb, args) steps as returned by parse_batch
+
+    files are moved step by step, in order, but command file changes from every step are
+    queued in one KBatch, so each affected command file is rewritten once at the end, and
+    the path index is updated once for all transcripts moved.  Command file trees for
+    remove <t> <k> are walked as they were before the batch.
 
+    a failed step stops the batch unless continue_on_error, the command file changes
+    of the steps that did run are still written
+
+    returns a dict with a result per step, {line,verb,args,ok,error}, and the list of
+    command files modified
+    """
+    global _path_index_pending
+    batch = KBatch()
+    results = []
+    _path_index_pending = moved = []
+    try:
+        for line, verb, args in steps:
+            result = {'line':line,'verb':verb,'args':args,'ok':True,'error':None}
+            results.append(result)
+            try:
+                if verb == 'rename':
+                    rename(args[0],args[1],update_k=False)
+                    batch.rename(args[0],args[1])
+                elif verb == 'delete':
+                    delete(args[0],update_k=False)
+                    batch.remove(args[0])
+                elif verb == 'undelete':
+                    undelete(*args)
+                elif verb == 'swap':
+                    batch.rename(args[0],args[1])
+                elif verb == 'remove' and len(args) == 2:
+                    k_files = [_k_name(this_k) for this_k, sub_k, these_t, these_e in walk_K(args[1])]
+                    batch.remove(args[0],only=k_files)
+                elif verb == 'remove':
+                    batch.remove(args[0])
+                else:
+                    raise ValueError ("'%s' can not be batched" % verb)
+            except Exception,e:
+                result['ok'] = False
+                result['error'] = str(e)
+                if not continue_on_error:
+                    break
+    finally:
+        _path_index_pending = None
+        modified = batch.commit()
+        if moved:
+            _path_index_changed(moved)
+    return {'steps':results,'modified':modified}
 
 def all_k(exclude=config.default_k_excludes):
     """lists all k files"""
@@ -279,35 +984,286 @@ def all_k(exclude=config.default_k_excludes):
                 partial = os.path.join(root,f).replace(k_dir,'').lstrip('/')
                 yield partial
 
-def sort(f,case_insensitive=True,in_place=True,outfile=None):
+def cache_path(name,create=True):
+    """full path of a radutil cache file, the cache directory is created if needed unless create is False"""
+    cache_dir = config.cache_dir or os.path.join(config.rad_dir,'.radutil')
+    if create and not _exists(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir,name)
+
+def _atomic_write(path,data):
+    """
+    writes data to a temp file next to path, then renames it into place
+
+    data is a string, or an iterable of strings written in turn
+    """
+    d = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(dir=d,prefix='.%s.' % os.path.basename(path))
+    try:
+        f = _fdopen(fd,'w',path)
+        if isinstance(data,str):
+            f.write(data)
+        else:
+            for chunk in data:
+                f.write(chunk)
+        f.close()
+        if _exists(path):
+            st = os.stat(path)
+            os.chmod(tmp,st.st_mode & 07777)
+            try:
+                os.chown(tmp,st.st_uid,st.st_gid)
+            except OSError:
+                pass
+        else:
+            os.chmod(tmp,0644)
+        os.rename(tmp,path)
+    except:
+        os.remove(tmp)
+        raise
+
+def _load_cache(name,default=None):
+    try:
+        with closing(_open(cache_path(name),'rb')) as src:
+            return pickle.load(src)
+    except (IOError,EOFError,pickle.UnpicklingError,ValueError):
+        return default
+
+def _save_cache(name,data):
+    _atomic_write(cache_path(name),pickle.dumps(data,2))
+
+def _parse_k_lines(k_file):
+    """
+    reads a command file into a list of (remove, type, path) tuples
+
+    remove is True for lines prefixed with '-'
+
+    """
+    entries = []
+    _emit('k_parse',k_file)
+    with closing(_open(k_file)) as src:
+        for line in src:
+            if line == '\n': continue
+            if line[0] == '#': continue
+            fields = line.split()
+            if not fields: continue
+            remove = False
+            if fields[0] == '-':
+                remove = True
+                del (fields[0])
+            if len(fields) < 2: continue
+            entries.append((remove,fields[0],fields[1]))
+    return entries
+
+# in memory copies of the reference index, keyed by cache file so a change of rad_dir
+# does not return stale results - each value is [records, reverse map, unsaved changes]
+_k_index = {}
+
+def _k_index_entry():
+    key = cache_path('k_index')
+    entry = _k_index.get(key)
+    if entry is None:
+        records = _load_cache('k_index',{})
+        if not isinstance(records,dict):
+            records = {}
+        entry = _k_index[key] = [records,None,False]
+    return entry
+
+def _save_k_index():
+    entry = _k_index_entry()
+    if entry[2]:
+        _save_cache('k_index',entry[0])
+        entry[2] = False
+
+def _k_name(K):
+    """the name of a command file relative to the command directory"""
+    k_dir = os.path.join(config.rad_dir,'command')
+    if os.path.isabs(K) and K.startswith(k_dir):
+        return K[len(k_dir):].lstrip('/')
+    return get_relative_path(K)
+
+def _k_entries(K):
+    """
+    the (remove, type, path) entries of a command file
+
+    answered from the reference index while the file's mtime and size are unchanged,
+    the single stat doubles as the existence check
+    """
+    k = _k_name(K)
+    k_file = os.path.join(config.rad_dir,'command',k)
+    try:
+        st = os.stat(k_file)
+    except OSError:
+        raise ValueError ("command %s not found in %s" % (k,config.rad_dir))
+    entry = _k_index_entry()
+    record = entry[0].get(k)
+    if record is None or record[0] != st.st_mtime or record[1] != st.st_size:
+        record = entry[0][k] = (st.st_mtime,st.st_size,_parse_k_lines(k_file))
+        entry[1] = None
+        entry[2] = True
+    return record[2]
+
+def _k_records():
+    """
+    returns the reference index as a dictionary of {k: (mtime, size, entries)}
+    for every command file listed by all_k
+
+    the index is persisted in the cache directory, and only command files whose
+    mtime or size changed since the last call are parsed again
+
+    """
+    entry = _k_index_entry()
+    index = entry[0]
+    current = Set()
+    for k in all_k():
+        current.add(k)
+        try:
+            _k_entries(k)
+        except ValueError:
+            continue
+    for k in index.keys():
+        # excluded command files may still be parsed when walked
+        if k not in current and not _exists(os.path.join(config.rad_dir,'command',k)):
+            del(index[k])
+            entry[1] = None
+            entry[2] = True
+    _save_k_index()
+    return dict([(k,index[k]) for k in current if k in index])
+
+def _k_reverse():
+    """returns the reverse reference map of {t or k name: set of referencing k}"""
+    index = _k_records()
+    entry = _k_index_entry()
+    if entry[1] is None:
+        reverse = {}
+        for k, record in index.iteritems():
+            for remove, kind, path in record[2]:
+                if kind in ('p','n','k'):
+                    reverse.setdefault(path,Set()).add(k)
+        entry[1] = reverse
+    return entry[1]
+
+def _forget_k(k):
+    """drops a command file from the in memory index so it is parsed again on next use"""
+    entry = _k_index.get(cache_path('k_index'))
+    if entry:
+        entry[0].pop(k,None)
+        entry[1] = None
+
+def find_references(item,recurse=False):
+    """
+    lists the command files that reference a transcript or command file
+
+    answers from the reference index rather than reading every command file
+
+    if recurse is True, command files that include a referencing command file
+    are also listed
+
+    """
+    reverse = _k_reverse()
+    found = Set()
+    wanted = [get_relative_path(item)]
+    while wanted:
+        for k in reverse.get(wanted.pop(),()):
+            if k not in found:
+                found.add(k)
+                if recurse:
+                    wanted.append(k)
+    return sorted(found)
+
+def _sort_key(line,case_sensitive):
+    fields = line.split()
+    if fields and fields[0] == '-':
+        del(fields[0])
+    if len(fields) < 2:
+        return ''
+    return _path_key(_decode_path(fields[1]),case_sensitive)
+
+def _spill(lines,case_sensitive):
+    """sorts lines and writes them to a temp file, returns the open file positioned at the start"""
+    lines.sort(key=lambda line: _sort_key(line,case_sensitive))
+    run = tempfile.TemporaryFile()
+    run.writelines(lines)
+    run.seek(0)
+    return run
+
+def _read_run(run,rank,case_sensitive):
+    for i, line in enumerate(run):
+        yield (_sort_key(line,case_sensitive),rank,i,line)
+
+# most runs merged at once, more are first merged down into a single run
+_max_runs = 64
+
+def _merge_runs(runs,case_sensitive):
+    merged = heapq.merge(*[_read_run(run,rank,case_sensitive) for rank, run in enumerate(runs)])
+    return (entry[3] for entry in merged)
+
+@phase('sort')
+def sort(f,case_insensitive=True,in_place=True,outfile=None,memory=None):
     """
     Sorts a transcript
     
     can sort a transcript in place, defaults to being case-insensitive
+
+    sorted in process in radmind path order: runs of up to memory megabytes
+    (default from the sort_memory config) are sorted and spilled to temp files,
+    then merged.  The destination is only replaced once the sort has completed.
+    Comment lines are kept at the top
     
     """
     if not (in_place or outfile):
-        # raise exception
-        pass
+        raise ValueError ("an outfile is needed unless sorting in place")
     f = get_full_path(f)
-    # bname = os.path.basename(f)
     if in_place:
-        infile = f+'_'
-        os.rename(f,infile)
         outfile = f
-    else:
-        infile = f
-    
-    cmd = ['lsort']
-    if case_insensitive:
-        cmd.append('-I')
-    cmd.extend(['-o',outfile,infile])
-    r = call(cmd)
-    if r:
-        # todo raise exception here and delete temp
-        pass
-    if os.path.exists(outfile) and in_place:
-        os.remove(infile)
+    if memory is None:
+        memory = int(config.sort_memory)
+    budget = int(memory * 2**20)
+    case_sensitive = not case_insensitive
+    comments = []
+    runs = []
+    lines = []
+    held = 0
+    try:
+        with closing(_open(f)) as src:
+            for line in src:
+                if line[0] == '#':
+                    comments.append(line)
+                    continue
+                if not line.strip():
+                    continue
+                lines.append(line)
+                held += len(line)
+                if held >= budget:
+                    runs.append(_spill(lines,case_sensitive))
+                    lines = []
+                    held = 0
+                    if len(runs) == _max_runs:
+                        run = tempfile.TemporaryFile()
+                        run.writelines(_merge_runs(runs,case_sensitive))
+                        run.seek(0)
+                        for old in runs:
+                            old.close()
+                        runs = [run]
+        if runs:
+            if lines:
+                runs.append(_spill(lines,case_sensitive))
+            lines = _merge_runs(runs,case_sensitive)
+        else:
+            lines.sort(key=lambda line: _sort_key(line,case_sensitive))
+        makedirs(outfile)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(outfile),prefix='.%s.' % os.path.basename(outfile))
+        try:
+            with closing(_fdopen(fd,'w',outfile)) as out:
+                out.writelines(comments)
+                out.writelines(lines)
+            os.chmod(tmp,os.stat(f).st_mode & 07777)
+            os.rename(tmp,outfile)
+        except:
+            os.remove(tmp)
+            raise
+    finally:
+        for run in runs:
+            run.close()
 
 def sum_item (f,human=False):
     if is_load(f):
@@ -315,63 +1271,526 @@ def sum_item (f,human=False):
     else:
         return sum_command (f,human=human)
 
+def _case_sensitive():
+    """config.case_sensitive, which is a string when read from a config file"""
+    value = config.case_sensitive
+    if isinstance(value,basestring):
+        return value.strip().lower() in ('1','yes','true','on')
+    return bool(value)
+
+def _path_key(path,case_sensitive=None):
+    """
+    sort key matching radmind's path ordering
+
+    '/' sorts before any other character so a directory's contents follow it directly
+    """
+    if case_sensitive is None:
+        case_sensitive = _case_sensitive()
+    if not case_sensitive:
+        path = path.lower()
+    return path.replace('/','\x01')
+
+def _t_path(path):
+    """turns an absolute path into the ./ relative form used in transcripts"""
+    if path.startswith('/'):
+        return '.' + path
+    return path
+
+def _t_size(fields):
+    """the size a split transcript line contributes to a sum - files and applefiles only"""
+    if fields[0] in ('f','a') and len(fields) > 6:
+        return int(fields[6])
+    return 0
+
+# transcripts are scanned in place through a read only map, one record (line) at a
+# time, and only the fields a caller needs are pulled out of each record
+_size_field = re.compile(r'^[fa][ \t]+(?:\S+[ \t]+){5}(\d+)',re.M)
+
+@contextmanager
+def _mapped(path,scan=True):
+    """
+    a read only map of path for the with block, '' for an empty file
+
+    the whole file is reported read, as a scan reads it, unless scan is False, when
+    the caller reports the bytes it touches
+    """
+    with closing(_open(path,'rb')) as src:
+        try:
+            data = mmap.mmap(src.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,mmap.error):
+            # empty file
+            yield ''
+            return
+        if scan:
+            _emit('read',path,bytes=len(data))
+        try:
+            yield data
+        finally:
+            data.close()
+
+def _lines(data,start=0):
+    """yields (offset, line) for each record of a mapped transcript from offset start"""
+    end = len(data)
+    while start < end:
+        stop = data.find('\n',start)
+        stop = end if stop < 0 else stop + 1
+        yield (start,data[start:stop])
+        start = stop
+
+def _line_at(data,offset):
+    """(start, end) of the record holding offset"""
+    start = data.rfind('\n',0,offset) + 1
+    end = data.find('\n',offset)
+    return (start,len(data) if end < 0 else end + 1)
+
+def t_sizes(T):
+    """lazily yields the size of each file and applefile in a transcript"""
+    with _mapped(get_full_path(T)) as data:
+        for m in _size_field.finditer(data):
+            yield int(m.group(1))
+
 def sum_transcript(T,human=False):
     """
     Sums the files listed in a transcript
     
     returns the number of bytes, defaults to number, unless human==True where it returns with human readable label
+
+    a fresh compiled index of the transcript is used when available
     
     """
-    sum_value = 0
-    t_file = get_full_path(T)
-    for line in open(t_file):
-        if line[0] in ('#','d','l','-'): continue
-        data = line.split()
-        # print line
-        if len(data)>6:
-            sum_value = sum_value + int(data[6])
+    index = transcript_index(T)
+    if index is not None:
+        sum_value = index.total_size
+        index.close()
+    else:
+        sum_value = _t_totals(get_full_path(T))[0]
     if human:
         return prettySize(sum_value)
     else:
         return sum_value
 
-def sum_command(K,human=False):
+class TranscriptIndex(object):
     """
-    Sums the files listed in all transcripts referenced by a command file
-    
-    returns the number of bytes, defaults to number, unless human==True where it returns with human readable label
-    
+    read only view of a compiled transcript index
+
+    the index file is memory mapped, and holds one record per transcript line in columns:
+    type, size, line number, byte offset, path and checksum, plus the record numbers
+    sorted in radmind path order for binary search.  Paths are stored decoded.
+
     """
-    transcripts = parse_K(K)['transcript']
-    sum_value = 0
-    for t in transcripts:
+    magic = 'RADIDX1\n'
+    header = struct.Struct('<8sqdBqqqq')
+
+    def __init__(self,idx_file):
+        self.src = _open(idx_file,'rb')
         try:
-            sum_value = sum_value + sum_transcript(t)
-        except:
-            print t
-            raise
-    if human:
-        return prettySize(sum_value)
-    else:
-        return sum_value
+            self.map = mmap.mmap(self.src.fileno(),0,access=mmap.ACCESS_READ)
+            (magic, self.t_size, self.t_mtime, case_sensitive, self.n, self.total_size,
+                self.file_count, path_len) = self.header.unpack_from(self.map,0)
+        except (ValueError,struct.error,mmap.error,EnvironmentError):
+            self.src.close()
+            raise ValueError ("%s is not a transcript index" % idx_file)
+        if magic != self.magic:
+            self.close()
+            raise ValueError ("%s is not a transcript index" % idx_file)
+        self.case_sensitive = bool(case_sensitive)
+        n = self.n
+        self._types = self.header.size
+        self._sizes = self._types + n
+        self._lines = self._sizes + 8 * n
+        self._offsets = self._lines + 4 * n
+        self._path_offs = self._offsets + 8 * n
+        self._sum_offs = self._path_offs + 8 * (n + 1)
+        self._order = self._sum_offs + 8 * (n + 1)
+        self._paths = self._order + 4 * n
+        self._sums = self._paths + path_len
 
-def check_t(t):
-    # should just be a call to lcksum validate...
-    # could use a function to just verify exists
-    # line ending check in its own func
-    return not checksums(t)
+    def close(self):
+        self.map.close()
+        self.src.close()
 
-def check_k(K,output=sys.stdout,error=sys.stderr,endings_only=False):
-    """
-    checks for errors in a command file
-    
-    checks that a command file, and all descendent command files and transcripts 
-    are properly terminated with a carriage return.
+    def __len__(self):
+        return self.n
+
+    def fresh(self,st):
+        return (self.t_size == st.st_size and self.t_mtime == st.st_mtime
+            and self.case_sensitive == _case_sensitive())
+
+    def _q(self,base,i):
+        return struct.unpack_from('<q',self.map,base + 8 * i)[0]
+
+    def type(self,i):
+        return self.map[self._types + i]
+
+    def size(self,i):
+        return self._q(self._sizes,i)
+
+    def line(self,i):
+        return struct.unpack_from('<I',self.map,self._lines + 4 * i)[0]
+
+    def offset(self,i):
+        return self._q(self._offsets,i)
+
+    def path(self,i):
+        start, end = struct.unpack_from('<qq',self.map,self._path_offs + 8 * i)
+        return self.map[self._paths + start:self._paths + end]
+
+    def checksum(self,i):
+        start, end = struct.unpack_from('<qq',self.map,self._sum_offs + 8 * i)
+        return self.map[self._sums + start:self._sums + end]
+
+    def sizes(self):
+        return struct.unpack_from('<%dq' % self.n,self.map,self._sizes)
+
+    def _sorted(self,j):
+        return struct.unpack_from('<I',self.map,self._order + 4 * j)[0]
+
+    def lookup(self,path,prefix=False):
+        """yields record numbers for path, or for every path starting with it if prefix is True"""
+        key = _path_key(_t_path(path),self.case_sensitive)
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _path_key(self.path(self._sorted(mid)),self.case_sensitive) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for j in xrange(lo,self.n):
+            i = self._sorted(j)
+            found = _path_key(self.path(i),self.case_sensitive)
+            if found == key or (prefix and found.startswith(key)):
+                yield i
+            else:
+                break
+
+def _index_path(t_file):
+    rel = os.path.relpath(t_file,config.rad_dir)
+    return cache_path(os.path.join('idx',rel + '.idx'),create=False)
+
+def _index_file(t_file):
+    idx_file = _index_path(t_file)
+    makedirs(idx_file)
+    return idx_file
+
+def _drop_index(t_file):
+    """removes the compiled index of a transcript, if there is one"""
+    idx_file = _index_path(t_file)
+    if _exists(idx_file):
+        os.remove(idx_file)
+
+def _move_index(t_file,new_file):
+    """moves the compiled index of a transcript along with the transcript"""
+    idx_file = _index_path(t_file)
+    if _exists(idx_file):
+        new_idx = _index_path(new_file)
+        makedirs(new_idx)
+        os.rename(idx_file,new_idx)
+
+_q = struct.Struct('<q')
+
+def _spooled_chunks(columns,size=2**20):
+    """yields the contents of each temp file column in turn, in chunks of size bytes"""
+    for column in columns:
+        column.seek(0)
+        chunk = column.read(size)
+        while chunk:
+            yield chunk
+            chunk = column.read(size)
+
+def compile_transcript(T):
+    """
+    writes the compiled index for a transcript to the radutil cache directory
+
+    the transcript is read once and each column packed into its own temp file as it
+    goes, so memory use does not grow with the transcript.  Only a transcript that is
+    not in radmind order needs its paths held in memory to sort them
+
+    returns the full path of the index
+    """
+    t_file = get_full_path(T)
+    st = os.stat(t_file)
+    case_sensitive = _case_sensitive()
+    # types, sizes, lines, offsets, path offsets, checksum offsets, order, paths, checksums
+    columns = [tempfile.TemporaryFile() for i in range(9)]
+    formats = [None,'<%dq','<%dI','<%dq','<%dq','<%dq','<%dI',None,None]
+    # values collected for each column, packed and written a batch at a time
+    batch = [[] for column in columns]
+    def flush():
+        for column, fmt, values in zip(columns,formats,batch):
+            if fmt is None:
+                column.write(''.join(values))
+            else:
+                column.write(struct.pack(fmt % len(values),*values))
+            del(values[:])
+    types, sizes, lines, offsets, path_offs, sum_offs, order, paths, sums = batch
+    try:
+        n = total = files = path_len = sum_len = 0
+        path_offs.append(0)
+        sum_offs.append(0)
+        in_order = True
+        last = None
+        with _mapped(t_file) as data:
+            for i, (offset, line) in enumerate(_lines(data)):
+                if line[0] == '#': continue
+                fields = line.split()
+                if len(fields) < 2: continue
+                if fields[0] == '-':
+                    # removal lines keep their '-' as the type
+                    fields = ['-'] + fields[2:]
+                size = _t_size(fields)
+                if fields[0] in ('f','a'):
+                    total += size
+                    files += 1
+                path = _decode_path(fields[1])
+                checksum = fields[0] in ('f','a') and len(fields) > 7 and fields[7] or ''
+                key = _path_key(path,case_sensitive)
+                if last is not None and key < last:
+                    in_order = False
+                last = key
+                types.append(fields[0][0])
+                sizes.append(size)
+                lines.append(i)
+                offsets.append(offset)
+                paths.append(path)
+                path_len += len(path)
+                path_offs.append(path_len)
+                sums.append(checksum)
+                sum_len += len(checksum)
+                sum_offs.append(sum_len)
+                n += 1
+                if not n % 65536:
+                    flush()
+        flush()
+        if in_order:
+            for start in xrange(0,n,65536):
+                order.extend(xrange(start,min(n,start + 65536)))
+                flush()
+        else:
+            columns[7].seek(0)
+            columns[4].seek(0)
+            blob = columns[7].read()
+            offs = struct.unpack('<%dq' % (n + 1),columns[4].read())
+            keys = [_path_key(blob[offs[i]:offs[i + 1]],case_sensitive) for i in xrange(n)]
+            del(blob)
+            order.extend(sorted(xrange(n),key=keys.__getitem__))
+            flush()
+        header = TranscriptIndex.header.pack(TranscriptIndex.magic,st.st_size,st.st_mtime,
+            int(case_sensitive),n,total,files,path_len)
+        idx_file = _index_file(t_file)
+        _atomic_write(idx_file,itertools.chain([header],_spooled_chunks(columns)))
+    finally:
+        for column in columns:
+            column.close()
+    return idx_file
+
+def transcript_index(T):
+    """
+    returns a TranscriptIndex for T if its compiled index is fresh, or None
+
+    with the transcript_index config set to manual, the default, only indexes written
+    with compile_transcript are used, set to auto a missing or stale index is compiled,
+    set to off no index is used
+    """
+    mode = config.transcript_index
+    if mode == 'off':
+        return None
+    t_file = get_full_path(T)
+    st = os.stat(t_file)
+    idx_file = _index_path(t_file)
+    if _exists(idx_file):
+        try:
+            index = TranscriptIndex(idx_file)
+        except ValueError:
+            pass
+        else:
+            if index.fresh(st):
+                return index
+            index.close()
+    if mode == 'auto':
+        compile_transcript(T)
+        index = TranscriptIndex(idx_file)
+        if index.fresh(st):
+            return index
+        # the transcript changed while compiling
+        index.close()
+    return None
+
+def find_path_in_T(path,T,prefix=False):
+    """
+    finds entries for a path in a transcript file
+
+    Returns a list of tuples of (line number, line) like find_in_T, the path may be
+    given as ./path or /path, if prefix is True every path starting with it is found.
+    Uses a binary search of the compiled index when available
+
+    """
+    t_file = get_full_path(T)
+    results = []
+    index = transcript_index(T)
+    if index is not None:
+        with closing(_open(t_file)) as src:
+            for i in index.lookup(path,prefix=prefix):
+                src.seek(index.offset(i))
+                results.append((index.line(i),src.readline()))
+        index.close()
+        results.sort()
+        return results
+    key = _path_key(_t_path(path))
+    with closing(_open(t_file)) as src:
+        for i, line in enumerate(src):
+            if line[0] == '#': continue
+            fields = line.split()
+            if len(fields) < 2: continue
+            if fields[0] == '-':
+                fields = fields[1:]
+            if len(fields) < 2: continue
+            found = _path_key(_decode_path(fields[1]))
+            if found == key or (prefix and found.startswith(key)):
+                results.append((i,line))
+    return results
+
+def sum_command(K,human=False):
+    """
+    Sums the files listed in all transcripts referenced by a command file
+    
+    returns the number of bytes, defaults to number, unless human==True where it returns with human readable label
+    
+    """
+    transcripts = parse_K(K)['transcript']
+    sum_value = 0
+    try:
+        for t in transcripts:
+            try:
+                sum_value = sum_value + transcript_stats(t)[0]
+            except:
+                print t
+                raise
+    finally:
+        _save_t_stats()
+    if human:
+        return prettySize(sum_value)
+    else:
+        return sum_value
+
+# in memory copies of the transcript statistics cache, keyed by cache file
+# each value is [{t: (mtime, size, bytes, files)}, unsaved changes]
+_t_stats = {}
+
+def _t_stats_entry():
+    key = cache_path('t_stats')
+    entry = _t_stats.get(key)
+    if entry is None:
+        stats = _load_cache('t_stats',{})
+        if not isinstance(stats,dict):
+            stats = {}
+        entry = _t_stats[key] = [stats,False]
+    return entry
+
+def _save_t_stats():
+    entry = _t_stats_entry()
+    if entry[1]:
+        _save_cache('t_stats',entry[0])
+        entry[1] = False
+
+def transcript_stats(T):
+    """
+    returns (bytes, file count) for a transcript
+
+    cached in the radutil cache directory by transcript name, mtime and size,
+    so unchanged transcripts are not read again.  Call _save_t_stats to persist
+    """
+    t_file = get_full_path(T)
+    t = os.path.relpath(t_file,os.path.join(config.rad_dir,'transcript'))
+    st = os.stat(t_file)
+    entry = _t_stats_entry()
+    record = entry[0].get(t)
+    if record and record[0] == st.st_mtime and record[1] == st.st_size:
+        return record[2:]
+    index = transcript_index(t_file)
+    if index is not None:
+        total, files = index.total_size, index.file_count
+        index.close()
+    else:
+        total, files = _t_totals(t_file)
+    entry[0][t] = (st.st_mtime,st.st_size,total,files)
+    entry[1] = True
+    return (total,files)
+
+def _t_totals(t_file):
+    """(bytes, file count) of a transcript, read from the file"""
+    total = files = 0
+    with _mapped(t_file) as data:
+        for m in _size_field.finditer(data):
+            total += int(m.group(1))
+            files += 1
+    return (total,files)
+
+@phase('sum')
+def sum_all(sort_by='name'):
+    """
+    sums every command file listed by all_k
+
+    each transcript's statistics are read once, and cached across runs
+
+    returns a list of dictionaries {command, bytes, files, transcripts, missing, error}
+    sorted by command name, or by bytes (largest first) if sort_by is 'size'.
+    missing lists transcripts referenced that were not found, error is why a command
+    file could not be parsed, or None
+    """
+    report = []
+    try:
+        for k in all_k():
+            row = {'command':k,'bytes':0,'files':0,'transcripts':0,'missing':[],'error':None}
+            report.append(row)
+            try:
+                transcripts = parse_K(k,supress_error=True)['transcript']
+            except (ValueError,RuntimeError),e:
+                row['error'] = str(e)
+                continue
+            for t in transcripts:
+                try:
+                    total, files = transcript_stats(t)
+                except (ValueError,OSError):
+                    row['missing'].append(t)
+                    continue
+                row['bytes'] += total
+                row['files'] += files
+                row['transcripts'] += 1
+    finally:
+        _save_t_stats()
+    if sort_by == 'size':
+        report.sort(key=lambda row: (-row['bytes'],row['command']))
+    else:
+        report.sort(key=lambda row: row['command'])
+    return report
+
+def check_t(t):
+    # should just be a call to lcksum validate...
+    # could use a function to just verify exists
+    # line ending check in its own func
+    return not checksums(t)
+
+@phase('check')
+def check_k(K,output=None,error=None,endings_only=False,force=False,quick=False):
+    """
+    checks for errors in a command file
+    
+    checks that a command file, and all descendent command files and transcripts 
+    are properly terminated with a carriage return.
     
     checks that every transcript file referenced exists
+
+    and verifies transcript checksums unless endings_only, force re-reads files
+    that are unchanged since the digest cache last saw them.  quick only compares
+    the stored files with the transcripts by stat, see quick_check
     
     """
+    if output is None:
+        output = sys.stdout
+    if error is None:
+        error = sys.stderr
     errors = []
+    to_verify = []
     def add_error(msg):
         errors.append(msg)
         error.write(msg + '\n')
@@ -383,7 +1802,7 @@ def check_k(K,output=sys.stdout,error=sys.stderr,endings_only=False):
             add_error(str(e))
         else:
             if not ending_ok(k_file):
-                add_error("%s is not terminated with a carriage return" % k)
+                add_error("%s is not terminated with a carriage return" % this_k)
         for t in these_t:
             try:
                 t_file = get_full_path(t)
@@ -393,22 +1812,137 @@ def check_k(K,output=sys.stdout,error=sys.stderr,endings_only=False):
                 if not ending_ok(t_file):
                     add_error("%s is not terminated with a carriage return" % t)
                 else:
-                    if not endings_only:
-                        try:
-                            checksums(t,output=output,error=error,opts=['-iq'])
-                        except RuntimeError:
-                            add_error("%s failed to verify" % t)
+                    if not (endings_only or t in to_verify):
+                        to_verify.append(t)
+    if to_verify:
+        # all transcripts are verified together so the work is spread over one worker pool
+        if quick:
+            failed = []
+            for problem in quick_check(to_verify):
+                error.write(_format_problem(problem) + '\n')
+                if problem['transcript'] not in failed:
+                    failed.append(problem['transcript'])
+            for t in failed:
+                add_error("%s failed the quick check" % t)
+        elif config.checksum_engine == 'lcksum':
+            for t in to_verify:
+                try:
+                    checksums(t,output=output,error=error,opts=['-iq'])
+                except RuntimeError:
+                    add_error("%s failed to verify" % t)
+        else:
+            failed = []
+            for problem in verify_transcripts(to_verify,force=force):
+                error.write(_format_problem(problem) + '\n')
+                if problem['transcript'] not in failed:
+                    failed.append(problem['transcript'])
+            for t in failed:
+                add_error("%s failed to verify" % t)
     return errors
     
+@phase('check')
+def check_all(endings_only=False,force=False,budget=None,processes=None,quick=False):
+    """
+    checks every command file from all_k, and every transcript they use, once
+
+    each command file is parsed and checked for its ending once, and the transcripts
+    used by any of them are gathered into one set, so a transcript shared by many
+    command files is checked for its ending and verified once.  Verification runs on
+    one worker pool, transcripts used by the most command files first.  A problem with
+    a transcript is reported against every command file that uses it, directly or
+    through included command files
+
+    endings_only skips verification, quick compares stored files with the transcripts
+    by stat only, see quick_check.  budget is a number of seconds after which no
+    further transcripts are verified, those left are listed as unchecked
+
+    returns a dict {commands, transcripts, unchecked, checked, seconds}, commands mapping
+    each command file with errors to its list of error messages, transcripts mapping each
+    transcript with problems to a list of messages
+    """
+    start = time.time()
+    commands = {}
+    problems = {}
+    # the error each command file using a transcript with problems is given
+    failed = {}
+    users = {}
+    def add_error(k,msg):
+        commands.setdefault(k,[]).append(msg)
+    for k in all_k():
+        try:
+            if not ending_ok(k):
+                add_error(k,"%s is not terminated with a carriage return" % k)
+            participating_K, transcripts, excludes = _parse_K(k)
+        except (ValueError,RuntimeError),e:
+            add_error(k,str(e))
+            continue
+        for t in transcripts:
+            users.setdefault(t,Set()).add(k)
+    to_verify = []
+    for t in users:
+        try:
+            t_file = get_full_path(t)
+        except ValueError,e:
+            problems[t] = failed[t] = [str(e)]
+            continue
+        if not ending_ok(t_file):
+            problems[t] = failed[t] = ["%s is not terminated with a carriage return" % t]
+        elif not endings_only:
+            to_verify.append(t)
+    # most shared first, so a budget covers the transcripts that matter to the most clients
+    to_verify.sort(key=lambda t: (-len(users[t]),t))
+    unchecked = []
+    if budget is None:
+        batches = [to_verify]
+    else:
+        size = max(8,_worker_count(processes) * 4)
+        batches = [to_verify[i:i + size] for i in range(0,len(to_verify),size)]
+    checked = 0
+    for batch in batches:
+        if budget is not None and time.time() - start > budget:
+            unchecked.extend(batch)
+            continue
+        if quick:
+            for problem in quick_check(batch,processes=processes):
+                t = problem['transcript']
+                problems.setdefault(t,[]).append(_format_problem(problem))
+                failed[t] = ["%s failed the quick check" % t]
+        elif config.checksum_engine == 'lcksum':
+            devnull = open(os.devnull,'w')
+            for t in batch:
+                try:
+                    checksums(t,output=devnull,error=devnull,opts=['-iq'])
+                except RuntimeError:
+                    problems[t] = failed[t] = ["%s failed to verify" % t]
+            devnull.close()
+        else:
+            for problem in verify_transcripts(batch,processes=processes,force=force):
+                t = problem['transcript']
+                problems.setdefault(t,[]).append(_format_problem(problem))
+                failed[t] = ["%s failed to verify" % t]
+        checked += len(batch)
+    for t, messages in failed.items():
+        for k in users[t]:
+            add_error(k,messages[0])
+    return {'commands':commands,'transcripts':problems,'unchecked':unchecked,
+        'checked':checked,'seconds':time.time() - start}
+
+_endings = {}
+
 def ending_ok(partial):
     """Utility function to check file ends with return"""
     full_path = get_full_path(partial)
-    f = open(full_path)
-    # go to end of file and read last byte
-    f.seek(-1,2)
-    ending = f.read(1)
-    f.close()
-    return ending == '\n'
+    st = os.stat(full_path)
+    stamp = (st.st_mtime,st.st_size,st.st_ino)
+    known = _endings.get(full_path)
+    if known and known[0] == stamp:
+        return known[1]
+    # only the last byte of the file is looked at
+    with _mapped(full_path,scan=False) as data:
+        ok = data[-1:] == '\n'
+        _emit('read',full_path,bytes=len(data[-1:]))
+    _endings[full_path] = (stamp,ok)
+    return ok
     
 def prettySize(size):
     """convert file size to human readable form"""
@@ -426,7 +1960,7 @@ def get_full_path(partial,loc=False,trash=False,must_exist=True):
     # accepting a full path here will break attempts to get file portion of transcript
     # as it shortcuts any value in loc
     
-    # if os.path.exists(partial):
+    # if _exists(partial):
     #     return partial
     
     # this may not be the best way to do it, 
@@ -444,13 +1978,13 @@ def get_full_path(partial,loc=False,trash=False,must_exist=True):
     if trash:
         sub = os.path.join('trash',sub)
     full_path = os.path.join(config.rad_dir,sub,partial)
-    if not os.path.exists(full_path) and must_exist:
+    if not _exists(full_path) and must_exist:
         raise ValueError ("%s %s not found in %s" % (sub,partial,config.rad_dir))
     return full_path
 
 def get_relative_path(partial):
     """simply strips relative path from /var/radmind bash completion"""
-    for pre in ('tmp/','transcript/'):
+    for pre in ('tmp/','transcript/','command/'):
         if partial.startswith(pre):
             partial = partial[len(pre):]
     return partial
@@ -462,34 +1996,238 @@ def find_in_T(pattern,T,escaped=True):
     Returns a list of tuples of (line number, line)
     pattern is escaped by default
     
+    """
+    return list(ifind_in_T(pattern,T,escaped))
+
+def ifind_in_T(pattern,T,escaped=True):
+    """
+    lazily yields (line number, line) for each line of a transcript matching pattern
+
+    the pattern is searched for across the whole mapped file, so only matching
+    lines are ever copied out of it
     """
     t_file = get_full_path(T)
-    results = []
     if escaped:
         pattern = re.escape(pattern)
     re_pat = re.compile(pattern)
-    with closing(open(t_file)) as src:
-        for i,line in enumerate(src):
-            # if pat in line:
+    # ^ and $ anchor at line boundaries, as they do against a single line
+    scan = re.compile(pattern,re.M)
+    with _mapped(t_file) as data:
+        i = 0
+        counted = 0
+        pos = 0
+        end = len(data)
+        while pos < end:
+            m = scan.search(data,pos)
+            if m is None:
+                break
+            start, stop = _line_at(data,m.start())
+            i += data[counted:start].count('\n')
+            counted = start
+            line = data[start:stop]
+            # a match may run past the end of its line, check it against the line alone
             if re_pat.search(line):
-                results.append((i,line))
+                yield (i,line)
+            pos = stop
+
+def _search_file(job):
+    """
+    worker function, scans one transcript for literal paths and regular expressions
+
+    job is (transcript, full path, {path key: [patterns]}, [regex strings], case sensitive),
+    returns (transcript, [(line number, line, [matched patterns])])
+    """
+    t, t_file, literals, regexes, case_sensitive = job
+    compiled = [(r,re.compile(r)) for r in regexes]
+    prefilter = compiled and re.compile('|'.join(['(?:%s)' % r for r in regexes]))
+    hits = []
+    with _mapped(t_file) as data:
+        for i, (offset, line) in enumerate(_lines(data)):
+            matched = []
+            if literals and line[0] != '#':
+                fields = line.split(None,3)
+                if fields and fields[0] == '-':
+                    del(fields[0])
+                if len(fields) > 1:
+                    matched.extend(literals.get(_path_key(_decode_path(fields[1]),case_sensitive),()))
+            if prefilter and prefilter.search(line):
+                matched.extend([r for r, c in compiled if c.search(line)])
+            if matched:
+                hits.append((i,line,matched))
+    return (t,hits)
+
+@phase('search')
+def search(paths=(),regexes=(),K=None,processes=None,errors=None):
+    """
+    searches transcripts for many paths and regular expressions in a single pass
+
+    paths are matched exactly against each entry's path, and may be given as ./path or /path.
+    regexes are searched for anywhere in the line, as find_in_T does.
+    Each distinct transcript referenced by the command files of all_k, or by K and
+    its descendents, is scanned once, spread over a pool of worker processes
+
+    returns a dictionary of {transcript: {'commands':[...],'hits':[(line number, line, [matched])]}}
+    for transcripts with hits, where commands lists every command file that includes the transcript
+
+    a command file that can not be parsed is skipped, an errors dict, if given, is
+    filled in with {command file: message} for each
+
+    """
+    case_sensitive = _case_sensitive()
+    literals = {}
+    for p in paths:
+        literals.setdefault(_path_key(_t_path(p),case_sensitive),[]).append(p)
+    regexes = list(regexes)
+    for r in regexes:
+        # fail early, rather than in a worker
+        re.compile(r)
+    referenced = OrderedDict()
+    for k in K and [K] or all_k():
+        try:
+            transcripts = parse_K(k,supress_error=True)['transcript']
+        except (ValueError,RuntimeError),e:
+            if errors is not None:
+                errors[k] = str(e)
+            continue
+        for t in transcripts:
+            referenced.setdefault(t,[]).append(k)
+    jobs = []
+    for t in referenced:
+        try:
+            jobs.append((t,get_full_path(t),literals,regexes,case_sensitive))
+        except ValueError:
+            continue
+    results = {}
+    for t, hits in _pool_map(_search_file,jobs,processes):
+        if hits:
+            results[t] = {'commands':referenced[t],'hits':hits}
     return results
 
+def _path_db():
+    """opens the path index database, creating it if needed"""
+    if sqlite3 is None:
+        raise RuntimeError ("the path index needs the sqlite3 module")
+    db = sqlite3.connect(cache_path('paths.db'))
+    db.text_factory = str
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS transcripts (name TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+        CREATE TABLE IF NOT EXISTS paths (key TEXT, path TEXT, transcript TEXT, line INTEGER);
+        CREATE INDEX IF NOT EXISTS paths_key ON paths (key);
+        CREATE INDEX IF NOT EXISTS paths_transcript ON paths (transcript);
+    """)
+    case = str(int(_case_sensitive()))
+    row = db.execute("SELECT value FROM meta WHERE name = 'case_sensitive'").fetchone()
+    if row is None or row[0] != case:
+        # keys depend on case sensitivity, start again
+        with db:
+            db.execute("DELETE FROM paths")
+            db.execute("DELETE FROM transcripts")
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('case_sensitive', ?)",(case,))
+    return db
+
+def _index_paths(db,t):
+    """replaces the path index rows of transcript t, or drops them if t no longer exists"""
+    db.execute("DELETE FROM paths WHERE transcript = ?",(t,))
+    db.execute("DELETE FROM transcripts WHERE name = ?",(t,))
+    t_file = os.path.join(config.rad_dir,'transcript',t)
+    try:
+        st = os.stat(t_file)
+    except OSError:
+        return
+    case_sensitive = _case_sensitive()
+    def rows():
+        with closing(_open(t_file)) as src:
+            for i, line in enumerate(src):
+                if line[0] == '#': continue
+                fields = line.split(None,3)
+                if fields and fields[0] == '-':
+                    del(fields[0])
+                if len(fields) < 2: continue
+                path = _decode_path(fields[1])
+                yield (_path_key(path,case_sensitive),path,t,i)
+    db.executemany("INSERT INTO paths VALUES (?,?,?,?)",rows())
+    db.execute("INSERT INTO transcripts VALUES (?,?,?)",(t,st.st_mtime,st.st_size))
+
+def all_t():
+    """lists all transcripts"""
+    t_dir = os.path.join(config.rad_dir,'transcript')
+    for root, dirs, files in os.walk(t_dir):
+        for f in files:
+            if is_load(f):
+                yield os.path.join(root,f)[len(t_dir):].lstrip('/')
+
+@phase('path index')
+def update_path_index(tlist=None):
+    """
+    brings the path index up to date
+
+    with no tlist every transcript whose mtime or size changed is indexed again,
+    and transcripts no longer present are dropped.  Otherwise only the listed
+    transcripts are updated
+
+    returns the number of transcripts indexed or dropped
+    """
+    db = _path_db()
+    try:
+        with db:
+            if tlist is None:
+                known = dict([(name,(mtime,size)) for name, mtime, size in
+                    db.execute("SELECT name, mtime, size FROM transcripts")])
+                tlist = []
+                for t in all_t():
+                    st = os.stat(os.path.join(config.rad_dir,'transcript',t))
+                    if known.pop(t,None) != (st.st_mtime,st.st_size):
+                        tlist.append(t)
+                tlist.extend(known.keys())
+            for t in tlist:
+                _index_paths(db,get_relative_path(t))
+    finally:
+        db.close()
+    return len(tlist)
+
+# while a batch runs, transcripts changed are collected here and indexed once at the end
+_path_index_pending = None
+
+def _path_index_changed(tlist):
+    """keeps an existing path index current after transcripts are added, moved or removed"""
+    if _path_index_pending is not None:
+        _path_index_pending.extend(tlist)
+    elif sqlite3 is not None and _exists(cache_path('paths.db')):
+        update_path_index(tlist)
+
+def locate(path,prefix=False):
+    """
+    finds the transcripts that list a path, from the path index
+
+    path may be given as ./path or /path, if prefix is True every path starting
+    with it is found.  The index is built on first use, see update_path_index
+
+    returns a sorted list of (transcript, line number, path)
+    """
+    if not _exists(cache_path('paths.db')):
+        update_path_index()
+    key = _path_key(_t_path(path))
+    db = _path_db()
+    try:
+        if prefix and key:
+            # every key starting with the prefix sorts below the prefix with its last byte raised
+            upper = key[:-1] + chr(ord(key[-1]) + 1)
+            rows = db.execute("SELECT transcript, line, path FROM paths WHERE key >= ? AND key < ?",
+                (key,upper)).fetchall()
+        else:
+            rows = db.execute("SELECT transcript, line, path FROM paths WHERE key = ?",(key,)).fetchall()
+    finally:
+        db.close()
+    rows.sort()
+    return rows
+
 def find_occurences(item):
     """finds occurrences of t or k in all k files"""
-    found_in = []
     item = get_relative_path(item)
-    if item.upper().endswith('.T'):
-        searching = 'transcript'
-    elif item.upper().endswith('.T'):
-        searching = 'command'
-    else:
+    if not item.upper().endswith(('.T','.K')):
         raise ValueError ("%s not a valid radmind file" % item)
-    for k in all_k():
-        parsed_k = parse_K(k)
-        if item in parsed_k[searching]:
-            found_in.append(k)
-    return found_in
+    return find_references(item,recurse=True)
     
 def list_pending():
     """
@@ -497,19 +2235,396 @@ def list_pending():
     """
     return os.listdir(os.path.join(config.rad_dir,'tmp','transcript'))
 
-def checksums(path,update=False,output=sys.stdout,error=sys.stderr,opts=['-%', '-iq']):
+_hash_chunk = 2**20
+
+_escape_re = re.compile(r'\\(.)')
+_escapes = {'b':' ','t':'\t','n':'\n','r':'\r','\\':'\\'}
+
+def _decode_path(path):
+    """decodes the escaping radmind applies to paths in transcripts"""
+    if '\\' not in path:
+        return path
+    return _escape_re.sub(lambda m: _escapes.get(m.group(1),m.group(1)),path)
+
+def _worker_count(processes=None):
+    if processes is None:
+        processes = int(config.processes)
+    if not processes and multiprocessing:
+        processes = multiprocessing.cpu_count()
+    return processes or 1
+
+def _pool_map(func,jobs,processes=None):
+    """
+    runs func over jobs in a pool of worker processes, yielding results as they complete
+
+    falls back to running in process when multiprocessing is not available
+    or only one worker is asked for
+
+    """
+    processes = _worker_count(processes)
+    if processes == 1 or not multiprocessing:
+        for job in jobs:
+            yield func(job)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(func,jobs,16):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _hash_file(job):
+    """
+    worker function, hashes a file in bounded chunks
+
+    job is a tuple starting (transcript, full path, algorithm, ...),
+    returns the job with the found checksum, or None and an error message
+    """
+    path, algorithm = job[1], job[2]
+    try:
+        h = hashlib.new(algorithm)
+        with closing(open(path,'rb')) as src:
+            while True:
+                data = src.read(_hash_chunk)
+                if not data:
+                    break
+                h.update(data)
+    except (IOError,OSError),e:
+        return job + (None,str(e))
+    return job + (base64.b64encode(h.digest()),None)
+
+def _file_dir(t_file):
+    """file storage directory for a full transcript path, also for loads pending in tmp"""
+    parts = os.path.relpath(t_file,config.rad_dir).split(os.sep)
+    if 'transcript' in parts[:2]:
+        parts[parts.index('transcript')] = 'file'
+    return os.path.join(config.rad_dir,*parts)
+
+def _checksum_jobs(t):
+    """yields a hash job for each file entry of transcript t that carries a checksum"""
+    t_file = get_full_path(t)
+    f_dir = _file_dir(t_file)
+    with closing(_open(t_file)) as src:
+        for line in src:
+            if line[0] in ('#','-'): continue
+            fields = line.split()
+            if len(fields) < 8 or fields[0] not in ('f','a') or fields[7] == '-':
+                continue
+            path = os.path.normpath(os.path.join(f_dir,_decode_path(fields[1])))
+            yield (t,path,config.checksum,int(fields[6]),fields[7])
+
+def _file_identity(st):
+    mtime_ns = getattr(st,'st_mtime_ns',None) or int(st.st_mtime * 1000000000)
+    return (st.st_ino,st.st_size,mtime_ns)
+
+class DigestCache(object):
+    """
+    persistent cache of file digests keyed on (path, inode, size, mtime, algorithm)
+
+    holds at most config.checksum_cache_size entries, the least recently used
+    are dropped first.  Stored with marshal as a flat list of tuples in LRU order.
+
+    """
+    version = 1
+
+    def __init__(self,name='digests'):
+        self.name = name
+        self.entries = OrderedDict()
+        self.dirty = False
+        # shared by checkin worker threads
+        self.lock = threading.Lock()
+        try:
+            with closing(_open(cache_path(name),'rb')) as src:
+                version, entries = marshal.loads(src.read())
+            if version == self.version:
+                for entry in entries:
+                    self.entries[entry[0]] = entry[1:]
+        except (IOError,EOFError,ValueError,TypeError):
+            pass
+
+    def get(self,path,identity,algorithm):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[:3] != identity or entry[3] != algorithm:
+                return None
+            # move to the most recently used end
+            del(self.entries[path])
+            self.entries[path] = entry
+            return entry[4]
+
+    def put(self,path,identity,algorithm,digest):
+        with self.lock:
+            self.entries.pop(path,None)
+            self.entries[path] = identity + (algorithm,digest)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            limit = int(config.checksum_cache_size)
+            while len(self.entries) > limit:
+                self.entries.popitem(last=False)
+            entries = [(path,) + entry for path, entry in self.entries.iteritems()]
+            _atomic_write(cache_path(self.name),marshal.dumps((self.version,entries)))
+            self.dirty = False
+
+_digest_caches = {}
+
+def digest_cache():
+    """the digest cache for the current rad_dir, loaded once per process"""
+    key = cache_path('digests')
+    if key not in _digest_caches:
+        _digest_caches[key] = DigestCache()
+    return _digest_caches[key]
+
+def _digest_jobs(jobs,force=False,processes=None,missing=None):
+    """
+    yields each job followed by the found digest and an error message
+
+    jobs are tuples starting (transcript, full path, algorithm, expected size, ...).
+    Files whose identity matches the digest cache are not read unless force is True,
+    missing files and size mismatches are reported to missing(job, size) and not hashed
+
+    """
+    cache = digest_cache()
+    to_hash = []
+    try:
+        for job in jobs:
+            try:
+                st = os.stat(job[1])
+            except OSError:
+                missing(job,None)
+                continue
+            if st.st_size != job[3]:
+                missing(job,st.st_size)
+                continue
+            identity = _file_identity(st)
+            digest = not force and cache.get(job[1],identity,job[2])
+            if digest:
+                yield job, digest, None
+            else:
+                to_hash.append(job + (identity,))
+        for result in _pool_map(_hash_file,to_hash,processes):
+            job, identity, digest, err = result[:-3], result[-3], result[-2], result[-1]
+            if digest is not None and _listeners:
+                _emit('open',job[1],mode='rb')
+                _emit('read',job[1],bytes=job[3])
+            if digest is not None:
+                cache.put(job[1],identity,job[2],digest)
+            yield job, digest, err
+    finally:
+        cache.save()
+
+@phase('checksums')
+def verify_transcripts(tlist,processes=None,force=False):
+    """
+    verifies the stored files of transcripts against their transcript checksums
+
+    files are hashed in process with hashlib, using the configured checksum,
+    spread over a pool of worker processes.  Files unchanged since they were last
+    hashed are answered from the digest cache unless force is True
+
+    returns a list of dictionaries describing each problem found:
+    {transcript, path, problem, expected, found}
+    where problem is one of missing, size, checksum or error
+
+    """
+    problems = []
+    def add_problem(job,problem,found):
+        problems.append({'transcript':job[0],'path':job[1],'problem':problem,
+            'expected':problem == 'size' and job[3] or job[4],'found':found})
+
+    def missing(job,size):
+        # size mismatches and missing files are found without reading any data
+        if size is None:
+            add_problem(job,'missing',None)
+        else:
+            add_problem(job,'size',size)
+
+    def jobs():
+        for t in tlist:
+            for job in _checksum_jobs(t):
+                yield job
+
+    for job, found, err in _digest_jobs(jobs(),force,processes,missing):
+        if err:
+            add_problem(job,'error',err)
+        elif found != job[4]:
+            add_problem(job,'checksum',found)
+    return problems
+
+def _stat_type(mode):
+    if stat.S_ISREG(mode):
+        return 'file'
+    if stat.S_ISDIR(mode):
+        return 'directory'
+    if stat.S_ISLNK(mode):
+        return 'link'
+    return 'special'
+
+def _stat_dir(job):
+    """
+    worker function, stats the stored files of one directory of a transcript
+
+    job is (transcript, directory, [(name, expected size)]), the directory is listed
+    once and each entry compared by its listing.  Returns a list of problems as
+    verify_transcripts does
+    """
+    t, directory, entries = job
+    problems = []
+    listing = {}
+    try:
+        if _os_scandir is not None:
+            for entry in _os_scandir(directory):
+                listing[entry.name] = entry
+        else:
+            for name in os.listdir(directory):
+                listing[name] = None
+    except OSError:
+        # a missing directory, every entry in it is missing
+        pass
+    for name, size in entries:
+        path = os.path.join(directory,name)
+        problem = found = None
+        if name not in listing:
+            problem = 'missing'
+        else:
+            entry = listing[name]
+            try:
+                if entry is None:
+                    st = os.lstat(path)
+                else:
+                    st = entry.stat(follow_symlinks=False)
+            except OSError:
+                problem = 'missing'
+            else:
+                if not stat.S_ISREG(st.st_mode):
+                    problem, found, size = 'type', _stat_type(st.st_mode), 'file'
+                elif st.st_size != size:
+                    problem, found = 'size', st.st_size
+        if problem:
+            problems.append({'transcript':t,'path':path,'problem':problem,
+                'expected':size,'found':found})
+    return problems
+
+@phase('stat')
+def quick_check(tlist,processes=None):
+    """
+    checks the stored files of transcripts against their transcript without reading them
+
+    each transcript is read once and its file entries grouped by directory, then each
+    directory is listed once, spread over a pool of worker processes, and its entries
+    compared with the transcript for existence, type and size.  Much faster than a
+    verify, it finds missing and truncated files but not changed contents
+
+    returns a list of problems as verify_transcripts does, where problem is one of
+    missing, type or size
+    """
+    def jobs():
+        for t in tlist:
+            t_file = get_full_path(t)
+            f_dir = _file_dir(t_file)
+            directories = OrderedDict()
+            with _mapped(t_file) as data:
+                for offset, line in _lines(data):
+                    if line[0] not in ('f','a'): continue
+                    fields = line.split()
+                    if len(fields) < 7: continue
+                    path = os.path.normpath(os.path.join(f_dir,_decode_path(fields[1])))
+                    directory, name = os.path.split(path)
+                    directories.setdefault(directory,[]).append((name,int(fields[6])))
+            for directory, entries in directories.iteritems():
+                yield (t,directory,entries)
+
+    problems = []
+    for found in _pool_map(_stat_dir,jobs(),processes):
+        problems.extend(found)
+    problems.sort(key=lambda p: (p['transcript'],p['path']))
+    return problems
+
+@phase('checksums')
+def update_transcript(t,processes=None,force=False):
+    """
+    updates the size and checksum fields of a transcript from its stored files
+
+    unchanged files are answered from the digest cache unless force is True.
+    The transcript is replaced with a temp file and rename
+
+    returns True if the transcript was changed
+    """
+    t_file = get_full_path(t)
+    f_dir = _file_dir(t_file)
+    with closing(_open(t_file)) as src:
+        lines = src.readlines()
+    jobs = []
+    for i, line in enumerate(lines):
+        if line[0] in ('#','-'): continue
+        fields = line.split()
+        if len(fields) < 8 or fields[0] not in ('f','a'):
+            continue
+        path = os.path.normpath(os.path.join(f_dir,_decode_path(fields[1])))
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            raise RuntimeError ('transcript failed to update, %s missing' % path)
+        jobs.append((t,path,config.checksum,size,fields[7],i))
+    def missing(job,size):
+        raise RuntimeError ('transcript failed to update, %s changed while updating' % job[1])
+    changed = False
+    for job, digest, err in _digest_jobs(jobs,force,processes,missing):
+        if err:
+            raise RuntimeError ('transcript failed to update, %s' % err)
+        fields = lines[job[5]].split()
+        if fields[6] != str(job[3]) or fields[7] != digest:
+            fields[6] = str(job[3])
+            fields[7] = digest
+            lines[job[5]] = ' '.join(fields) + '\n'
+            changed = True
+    if changed:
+        _atomic_write(t_file,''.join(lines))
+    return changed
+
+def _format_problem(problem):
+    return "%(transcript)s: %(path)s %(problem)s (expected %(expected)s, found %(found)s)" % problem
+
+def checksums(path,update=False,output=None,error=None,opts=None,force=False,processes=None):
+    """
+    verifies a transcript, or updates its checksums
+
+    done in process unless the checksum_engine config is lcksum, force re-reads
+    files that the digest cache has already seen
+
+    returns 1 if an update changed the transcript, like lcksum
+    """
+    if output is None:
+        output = sys.stdout
+    if error is None:
+        error = sys.stderr
+    if config.checksum_engine != 'lcksum':
+        if update:
+            return int(update_transcript(path,processes=processes,force=force))
+        problems = verify_transcripts([path],processes=processes,force=force)
+        for problem in problems:
+            error.write(_format_problem(problem) + '\n')
+        if problems:
+            raise RuntimeError ('transcript failed to verify')
+        return 0
+    if opts is None:
+        opts = ['-%', '-iq']
     cmd = ['lcksum']
-    opts.append('-c'+config.checksum)
+    cmd.extend(opts)
+    cmd.append('-c'+config.checksum)
     if not config.case_sensitive:
-        opts.append('-I')
+        cmd.append('-I')
     if not update:
-        opts.append('-n')
-    cmd.extend(opts)
+        cmd.append('-n')
     path = get_full_path(path)
     cmd.append(path)
-    process = Popen(' '.join(cmd),shell=True,stdout=output,stderr=error)
     # need to pipe output and error properly here?
-    o,e = process.communicate()
+    process, o, e = _run(cmd,stdout=output,stderr=error)
     if process.returncode:
         if (update and process.returncode > 1):
             raise RuntimeError ('transcript failed to update')
@@ -517,77 +2632,323 @@ def checksums(path,update=False,output=sys.stdout,error=sys.stderr,opts=['-%', '
             raise RuntimeError ('transcript failed to verify')
     return process.returncode
     
-def checkin(load,update=False,output=sys.stdout,error=sys.stderr):
-    """
-    checkin an uploaded (lcreate) loadset
-    """
+def _move(old,new):
+    """renames old to new, moving across filesystems when a rename is not possible"""
+    start = time.time()
+    try:
+        os.rename(old,new)
+    except OSError,e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(old,new)
+    _emit('move',old,new=new,seconds=time.time() - start)
+
+def _checkin_paths(load):
+    """returns the (transcript, file) source and destination paths of a pending load"""
     load_transcript = os.path.join(config.rad_dir,'tmp','transcript',load)
     if not os.path.exists (load_transcript):
         raise RuntimeError ('%s not found' % load)
     t_dest = os.path.join(config.rad_dir,'transcript',os.path.basename(load_transcript))
     load_files = os.path.join(config.rad_dir,'tmp','file',load)
     f_dest = os.path.join(config.rad_dir,'file',os.path.basename(load_files))
-    if os.path.exists (t_dest) or os.path.exists(f_dest):
+    if os.path.exists (t_dest) or _exists(f_dest):
         raise RuntimeError ('loadset %s already exists' % load)
-    result = checksums (load_transcript,update=update,output=output,error=error)
-    shutil.move(load_transcript,t_dest)
-    shutil.move(load_files,f_dest)
+    return load_transcript, t_dest, load_files, f_dest
+
+def _checkin_move(load,load_transcript,t_dest,load_files,f_dest):
+    _drop_index(load_transcript)
+    _drop_index(t_dest)
+    _move(load_transcript,t_dest)
+    if _exists(load_files):
+        _move(load_files,f_dest)
+    _path_index_changed([os.path.basename(t_dest)])
+
+@phase('checkin')
+def checkin(load,update=False,output=None,error=None,processes=None):
+    """
+    checkin an uploaded (lcreate) loadset
+    """
+    if output is None:
+        output = sys.stdout
+    if error is None:
+        error = sys.stderr
+    paths = _checkin_paths(load)
+    result = checksums (paths[0],update=update,output=output,error=error,processes=processes)
+    _checkin_move(load,*paths)
     return result
 
-def checkin_all(update=False,output=sys.stdout,error=sys.stderr,continue_on_error=True):
-    for load in list_pending():
-        try:
-            checkin (load,update=update,output=output,error=error)         
-        except:
-            if continue_on_error:
-                continue
+@phase('checkin')
+def checkin_all(update=False,output=None,error=None,continue_on_error=True,workers=None):
+    """
+    checks in every pending loadset
+
+    loads are verified (or updated) on a bounded pool of worker threads, and each is
+    moved into place as soon as its verification completes.  A failure stops the
+    remaining loads and is raised unless continue_on_error
+
+    returns a list of dictionaries {load, ok, error, bytes, seconds} in order of completion
+    """
+    if output is None:
+        output = sys.stdout
+    if error is None:
+        error = sys.stderr
+    pending = Queue.Queue()
+    done = Queue.Queue()
+    stop = threading.Event()
+    loads = list_pending()
+    for load in loads:
+        pending.put(load)
+
+    outer = current_phase()
+    def worker():
+        _phase.name = outer
+        while not stop.is_set():
+            try:
+                load = pending.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            total = 0
+            try:
+                paths = _checkin_paths(load)
+                total = _t_totals(paths[0])[0]
+                # one process per load, the threads already spread the work
+                checksums(paths[0],update=update,output=output,error=error,processes=1)
+            except Exception,e:
+                done.put((load,None,total,start,e))
             else:
-                raise
+                done.put((load,paths,total,start,None))
+
+    threads = [threading.Thread(target=worker) for i in range(min(_worker_count(workers),len(loads)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    results = []
+    failure = None
+    try:
+        while len(results) < len(loads) and failure is None:
+            try:
+                # a timeout keeps the wait interruptible
+                load, paths, total, start, e = done.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if e is None:
+                try:
+                    _checkin_move(load,*paths)
+                except Exception,e:
+                    pass
+            results.append({'load':load,'ok':e is None,'error':e and str(e) or None,
+                'bytes':total,'seconds':time.time() - start})
+            if e is not None and not continue_on_error:
+                failure = e
+                stop.set()
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if failure is not None:
+        raise failure
+    return results
 
+def _t_entries(t_file,rank=0):
+    """
+    yields (key, rank, removed, fields, line) for each entry of a sorted transcript
+
+    fields is the split line without any leading '-', removed is True for '-' lines,
+    key is the radmind sort key of the decoded path.  Raises RuntimeError if the
+    transcript is out of order
+    """
+    case_sensitive = _case_sensitive()
+    last = None
+    with closing(_open(t_file)) as src:
+        for line in src:
+            if line[0] == '#': continue
+            fields = line.split()
+            removed = fields and fields[0] == '-'
+            if removed:
+                del(fields[0])
+            if len(fields) < 2: continue
+            key = _path_key(_decode_path(fields[1]),case_sensitive)
+            if last is not None and key < last:
+                raise RuntimeError ("%s is not sorted" % t_file)
+            last = key
+            yield (key,rank,removed,fields,line)
+
+def _merge_groups(t_files):
+    """
+    k-way merge of sorted transcripts, t_files listed highest precedence first
+
+    yields the list of entries for each path, highest precedence first, holding only
+    one line per transcript in memory
+    """
+    group = []
+    for entry in heapq.merge(*[_t_entries(t,rank) for rank, t in enumerate(t_files)]):
+        if group and entry[0] != group[0][0]:
+            yield group
+            group = []
+        group.append(entry)
+    if group:
+        yield group
+
+# fields holding what a path contains, for each transcript line type, the rest are metadata
+_content_fields = {'f':(6,7),'a':(6,7),'l':(2,),'h':(2,),'c':(5,6),'b':(5,6)}
+
+def _diff_kind(old,new):
+    """how two entries for the same path differ, content, metadata or None"""
+    if old[2] != new[2] or old[3][0] != new[3][0]:
+        # removed in one, or a different type of entry
+        return 'content'
+    content = _content_fields.get(old[3][0],())
+    if [old[3][i:i + 1] for i in content] != [new[3][i:i + 1] for i in content]:
+        return 'content'
+    if [f for i, f in enumerate(old[3]) if i > 1 and i not in content] != \
+        [f for i, f in enumerate(new[3]) if i > 1 and i not in content]:
+        return 'metadata'
+    return None
+
+def diff_transcripts(t1,t2,totals=None):
+    """
+    compares two sorted transcripts, yielding (change, path, old fields, new fields)
+
+    change is added, removed, content (type, size, checksum or link target differ) or
+    metadata (mode, owner, group or mtime differ), fields are the split lines, None
+    where the path is missing.  Both transcripts are streamed together, in the sort
+    order of the case_sensitive config, so memory use does not grow with their size.
+
+    a totals dict, if given, is filled in with the number of each change, the stored
+    bytes of the new entries added or changed, of the old entries removed or changed,
+    and the net change in stored bytes
+    """
+    if totals is not None:
+        totals.update({'added':0,'removed':0,'content':0,'metadata':0,
+            'bytes_added':0,'bytes_removed':0,'bytes_delta':0})
+    for group in _merge_groups([get_full_path(t1),get_full_path(t2)]):
+        old = [e for e in group if e[1] == 0][:1]
+        new = [e for e in group if e[1] == 1][:1]
+        if old and new:
+            change = _diff_kind(old[0],new[0])
+            if change is None:
+                continue
+        else:
+            change = old and 'removed' or 'added'
+        old_fields = old and old[0][3] or None
+        new_fields = new and new[0][3] or None
+        if totals is not None:
+            totals[change] += 1
+            old_size = old and not old[0][2] and _t_size(old_fields) or 0
+            new_size = new and not new[0][2] and _t_size(new_fields) or 0
+            if change != 'metadata':
+                totals['bytes_added'] += new_size
+                totals['bytes_removed'] += old_size
+                totals['bytes_delta'] += new_size - old_size
+        yield change, _decode_path(group[0][3][1]), old_fields, new_fields
+
+def _link_file(src,dst):
+    """hard links src to dst, replacing dst, copying when a link is not possible"""
+    makedirs(dst)
+    tmp = '%s.radutil-%s' % (dst,uuid.uuid4().hex)
+    try:
+        os.link(src,tmp)
+    except OSError,e:
+        if e.errno not in (errno.EXDEV,errno.EPERM,errno.EMLINK,errno.ENOTSUP):
+            raise
+        shutil.copy2(src,tmp)
+    os.rename(tmp,dst)
+
+@phase('transcripts')
+def _merge_into(t_files,t_file,dest_rank=None):
+    """
+    streams a merge of t_files, highest precedence first, into the transcript t_file
+
+    the stored files of winning entries are hard linked into a staging directory next
+    to t_file's file storage, and only moved into it once the whole merge has been
+    written, so a failed merge leaves neither the transcript nor its files changed.
+    If dest_rank is given t_files[dest_rank] is t_file itself, and its entries that
+    win are left untouched on disk.  Winning '-' lines remove the path from the output.
+    """
+    f_dirs = [_file_dir(t) for t in t_files]
+    f_dir = _file_dir(t_file)
+    makedirs(t_file)
+    makedirs(f_dir)
+    staging = '%s.radutil-%s' % (f_dir,uuid.uuid4().hex)
+    staged = []
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(t_file),prefix='.%s.' % os.path.basename(t_file))
+    try:
+        with closing(_fdopen(fd,'w',t_file)) as out:
+            for group in _merge_groups(t_files):
+                key, rank, removed, fields, line = group[0]
+                if removed:
+                    continue
+                out.write(line)
+                if rank != dest_rank and fields[0] in ('f','a'):
+                    path = _decode_path(fields[1])
+                    _link_file(os.path.join(f_dirs[rank],path),os.path.join(staging,path))
+                    staged.append(path)
+        if _exists(t_file):
+            st = os.stat(t_file)
+            os.chmod(tmp,st.st_mode & 07777)
+        else:
+            os.chmod(tmp,0644)
+    except:
+        os.remove(tmp)
+        if _exists(staging):
+            shutil.rmtree(staging)
+        raise
+    if staged:
+        if not _exists(f_dir):
+            os.rename(staging,f_dir)
+        else:
+            for path in staged:
+                dst = os.path.join(f_dir,path)
+                makedirs(dst)
+                os.rename(os.path.join(staging,path),dst)
+            shutil.rmtree(staging)
+    elif not _exists(f_dir):
+        os.mkdir(f_dir)
+    os.rename(tmp,t_file)
 
+@phase('merge')
 def merge(tlist,dest,delete_combined=True,update_K=True):
     """
     similar to combine, but dest exists
+
+    dest takes the highest precedence, and is updated in place: only the stored files
+    of entries taken from the other transcripts are linked into dest's file storage
     """
     
     full_dest = get_full_path(dest,must_exist=False)
-    if not os.path.exists(full_dest):
+    if not _exists(full_dest):
         raise RuntimeError ("merge destination does not exist, use combine function instead")
-    tmp = 'tmp-%s' % str(uuid.uuid4())
-    tlist.append(dest)
-    result = combine (tlist,tmp,delete_combined=False,update_K=False)
-    if not result:
-        delete (dest,update_K=False)
-        rename (tmp,dest)
-        if update_K:
-            tlist.pop()
-            # going from passed, to full, to relative is to handle bash completion of transcript/foo.T
-            # instead of just foo.T as it would appear in k file
-            full_tlist = [get_full_path(t) for t in tlist]
-            t_dir = os.path.join(config.rad_dir,'transcript')
-            rel_dest = full_dest.replace(t_dir,'').lstrip('/')
-            rel_tlist = [t.replace(t_dir,'').lstrip('/') for t in full_tlist]
-            modified_k = []
-            for k in all_k():
-                k_parsed = parse_K(k)
-                if dest in k_parsed['transcripts']:
-                    for t in rel_tlist:
-                            remove_t_in_k (k,t,recurse=False)
-                else:
-                    for t in rel_tlist:
-                        if k not in modified_k:
-                            if rename_t_in_k(k,t,rel_dest,recurse=False):
-                                modified_k.append(k)
-                        else:
-                            remove_t_in_k (k,t,recurse=False)
-        if delete_combined:
-            for t in tlist:
-                delete(t,update_k=False)
-    return result
+    # going from passed, to full, to relative is to handle bash completion of transcript/foo.T
+    # instead of just foo.T as it would appear in k file
+    full_tlist = [get_full_path(t) for t in tlist]
+    # lowest precedence first, with dest last - reversed for the merge
+    merge_list = [full_dest] + list(reversed(full_tlist))
+    _merge_into(merge_list,full_dest,dest_rank=0)
+    _path_index_changed([get_relative_path(dest)])
+    if update_K:
+        t_dir = os.path.join(config.rad_dir,'transcript')
+        rel_dest = full_dest.replace(t_dir,'').lstrip('/')
+        # highest precedence first
+        rel_tlist = [t.replace(t_dir,'').lstrip('/') for t in reversed(full_tlist)]
+        # command files already using dest just lose the inputs, others get dest
+        # in place of the highest precedence input they use
+        batch = KBatch()
+        batch.collapse(rel_tlist,rel_dest)
+        batch.commit()
+    if delete_combined:
+        for t in tlist:
+            delete(t,update_k=False)
+    return 0
     
+@phase('combine')
 def combine(tlist,dest,delete_combined=True,update_K=True):
     """
     combine multiple loads into one, and replace occurrences of those transcripts in command files
+
+    transcripts are listed lowest precedence first, the opposite of lmerge.  The sorted
+    transcripts are merged in process, and the winning stored files hard linked into
+    the file storage of dest (copied when on another filesystem)
     
     """
     full_tlist = [get_full_path(t) for t in tlist]
@@ -595,37 +2956,338 @@ def combine(tlist,dest,delete_combined=True,update_K=True):
     # important, choosing to reverse the order of meaning for transcripts from lmerge
     # lowest precedence first - opposite of lmerge
     full_tlist.reverse()
-    if os.path.exists(full_dest):
+    if _exists(full_dest):
         return merge(tlist,dest,delete_combined=delete_combined,update_K=update_K)
         # raise RuntimeError ("Target transcript already exists")
-    full_dest_file = get_full_path(dest,loc='file',must_exist=False)
-    cmd = ['lmerge']
-    if not config.case_sensitive:
-        cmd.append('-I')
-    cmd.extend(full_tlist)
-    cmd.append(full_dest)
-    makedirs(full_dest)
-    makedirs(full_dest_file)
-    result = call(cmd)
-    if not result:
-        if update_K:
-            # relative versions
-            t_dir = os.path.join(config.rad_dir,'transcript')
-            rel_dest = full_dest.replace(t_dir,'').lstrip('/')
-            rel_tlist = [t.replace(t_dir,'').lstrip('/') for t in full_tlist]
-            modified_k = []
-            for k in all_k():
-                for t in rel_tlist:
-                    if k not in modified_k:
-                        if rename_t_in_k(k,t,rel_dest,recurse=False):
-                            modified_k.append(k)
-                    else:
-                        remove_t_in_k (k,t,recurse=False)
-        if delete_combined:
-            for t in tlist:
-                delete(t,update_k=False)
-    return result
+    _merge_into(full_tlist,full_dest)
+    _path_index_changed([get_relative_path(dest)])
+    if update_K:
+        # relative versions
+        t_dir = os.path.join(config.rad_dir,'transcript')
+        rel_dest = full_dest.replace(t_dir,'').lstrip('/')
+        rel_tlist = [t.replace(t_dir,'').lstrip('/') for t in full_tlist]
+        # the highest precedence input in each command file becomes dest, the rest are removed
+        batch = KBatch()
+        batch.collapse(rel_tlist,rel_dest)
+        batch.commit()
+    if delete_combined:
+        for t in tlist:
+            delete(t,update_k=False)
+    return 0
+
+def select_t(patterns,order='name',exclude=()):
+    """
+    expands a list of transcript names and glob patterns into transcripts, lowest precedence first
+
+    patterns are matched against every transcript, as named in command files, and each
+    pattern's matches are placed in order by name, or by mtime (oldest first, ties by
+    name) where the pattern stood.  A transcript selected twice keeps its first place,
+    those in exclude are never selected.  Raises ValueError for a pattern matching nothing
+    """
+    if order not in ('name','mtime'):
+        raise ValueError ("unknown order %s, must be name or mtime" % order)
+    exclude = Set([get_relative_path(t) for t in exclude])
+    t_dir = os.path.join(config.rad_dir,'transcript')
+    transcripts = None
+    selected = []
+    for pattern in patterns:
+        pattern = get_relative_path(pattern)
+        if not re.search(r'[*?[]',pattern):
+            matched = [pattern]
+        else:
+            if transcripts is None:
+                transcripts = sorted(all_t())
+            matched = [t for t in transcripts if fnmatch.fnmatchcase(t,pattern) and t not in exclude]
+            if not matched:
+                raise ValueError ("no transcripts match %s" % pattern)
+            if order == 'mtime':
+                matched.sort(key=lambda t: (os.stat(os.path.join(t_dir,t)).st_mtime,t))
+        for t in matched:
+            if t not in selected and t not in exclude:
+                selected.append(t)
+    return selected
+
+@phase('combine')
+def combine_plan(tlist,dest):
+    """
+    what combining tlist into dest would do, nothing is written
+
+    the inputs are merged as combine, or merge when dest exists, would merge them, only
+    counting the result.  Returns a dict:
+
+        dest, merge (True when dest exists and is merged into)
+        inputs, for each transcript lowest precedence first (dest last when merging),
+            {transcript, entries, kept, bytes}: its entries, those in the result, and
+            the stored bytes of its files in the result
+        entries, files, bytes of the result
+        commands, {command file: {removed: [lines], added: [lines]}} for each command
+            file that would change
+    """
+    full_tlist = [get_full_path(t) for t in tlist]
+    full_dest = get_full_path(dest,must_exist=False)
+    merging = _exists(full_dest)
+    names = [get_relative_path(t) for t in tlist]
+    if merging:
+        names.append(get_relative_path(dest))
+        full_tlist.append(full_dest)
+    inputs = [{'transcript':t,'entries':0,'kept':0,'bytes':0} for t in names]
+    plan = {'dest':get_relative_path(dest),'merge':merging,'inputs':inputs,
+        'entries':0,'files':0,'bytes':0,'commands':OrderedDict()}
+    # highest precedence first for the merge
+    last = len(full_tlist) - 1
+    for group in _merge_groups(list(reversed(full_tlist))):
+        for entry in group:
+            inputs[last - entry[1]]['entries'] += 1
+        key, rank, removed, fields, line = group[0]
+        if removed:
+            continue
+        size = _t_size(fields)
+        winner = inputs[last - rank]
+        winner['kept'] += 1
+        winner['bytes'] += size
+        plan['entries'] += 1
+        if fields[0] in ('f','a'):
+            plan['files'] += 1
+        plan['bytes'] += size
+    batch = KBatch()
+    batch.collapse(list(reversed([get_relative_path(t) for t in tlist])),dest)
+    for k, (lines, new_lines) in batch.preview().items():
+        plan['commands'][k] = {'removed':[l for l in lines if l not in new_lines],
+            'added':[l for l in new_lines if l not in lines]}
+    return plan
                 
+def _same_bytes(job):
+    """worker function, job is (original, duplicate, size), returns the job and whether their bytes match"""
+    original, duplicate = job[0], job[1]
+    try:
+        with closing(open(original,'rb')) as a:
+            with closing(open(duplicate,'rb')) as b:
+                while True:
+                    data = a.read(_hash_chunk)
+                    if data != b.read(_hash_chunk):
+                        return job + (False,)
+                    if not data:
+                        return job + (True,)
+    except (IOError,OSError):
+        return job + (False,)
+
+def _dedupe_record():
+    """the dedupe record, {transcripts: {t: (mtime, size)}, files: {(checksum, size): stored path}}"""
+    record = _load_cache('dedupe')
+    if not isinstance(record,dict) or record.get('checksum') != config.checksum:
+        record = {'checksum':config.checksum,'transcripts':{},'files':{}}
+    return record
+
+@phase('dedupe')
+def dedupe(dry_run=False,rescan=False,processes=None):
+    """
+    hard links identical stored files together
+
+    transcripts are streamed and their stored files grouped by checksum and size, the
+    first file seen for each is kept and later ones whose bytes match it are replaced
+    with a hard link to it.  A record of the transcripts considered, and the file kept for
+    each checksum, is kept in the radutil cache so later runs only read transcripts
+    added or changed since, unless rescan.  dry_run compares files but links nothing
+
+    returns a dict {transcripts, files, bytes, skipped, cross_device}, transcripts read,
+    files linked (or that would be), bytes reclaimed (only files not already linked
+    elsewhere are counted), files whose size or bytes did not match their checksum group,
+    and files that can not be linked as they are on another filesystem to the kept file
+    """
+    record = _dedupe_record()
+    if rescan:
+        record['transcripts'] = {}
+    seen = record['transcripts']
+    kept = record['files']
+    t_dir = os.path.join(config.rad_dir,'transcript')
+    current = Set()
+    to_read = []
+    for t in all_t():
+        current.add(t)
+        st = os.stat(os.path.join(t_dir,t))
+        if seen.get(t) != (st.st_mtime,st.st_size):
+            to_read.append((t,(st.st_mtime,st.st_size)))
+    for t in seen.keys():
+        if t not in current:
+            del(seen[t])
+    jobs = []
+    for t, stamp in to_read:
+        t_file = os.path.join(t_dir,t)
+        f_dir = _file_dir(t_file)
+        with closing(_open(t_file)) as src:
+            for line in src:
+                if line[0] not in ('f','a'): continue
+                fields = line.split()
+                if len(fields) < 8 or fields[7] == '-': continue
+                size = _t_size(fields)
+                if not size: continue
+                key = (fields[7],size)
+                path = os.path.relpath(os.path.join(f_dir,_decode_path(fields[1])),config.rad_dir)
+                if key not in kept:
+                    kept[key] = path
+                elif kept[key] != path:
+                    jobs.append((key,path))
+        seen[t] = stamp
+    report = {'transcripts':len(to_read),'files':0,'bytes':0,'skipped':0,'cross_device':0}
+    to_compare = []
+    for key, path in jobs:
+        original = os.path.join(config.rad_dir,kept[key])
+        duplicate = os.path.join(config.rad_dir,path)
+        try:
+            b = os.lstat(duplicate)
+        except OSError:
+            continue
+        try:
+            a = os.stat(original)
+        except OSError:
+            # the kept file has gone, this duplicate takes its place
+            kept[key] = path
+            continue
+        if (a.st_dev,a.st_ino) == (b.st_dev,b.st_ino):
+            continue
+        if a.st_size != b.st_size:
+            report['skipped'] += 1
+            continue
+        if a.st_dev != b.st_dev:
+            # a hard link can not cross filesystems, whatever the bytes
+            report['cross_device'] += 1
+            continue
+        to_compare.append((original,duplicate,key[1],key,b.st_nlink))
+    for original, duplicate, size, key, links, same in _pool_map(_same_bytes,to_compare,processes):
+        if not same:
+            report['skipped'] += 1
+            continue
+        if not dry_run:
+            tmp = '%s.radutil-%s' % (duplicate,uuid.uuid4().hex)
+            try:
+                os.link(original,tmp)
+            except OSError,e:
+                if e.errno != errno.EMLINK:
+                    raise
+                # the kept file has as many links as it can, start again from this one
+                kept[key] = os.path.relpath(duplicate,config.rad_dir)
+                continue
+            os.rename(tmp,duplicate)
+        report['files'] += 1
+        if links == 1:
+            report['bytes'] += size
+    if not dry_run:
+        _save_cache('dedupe',record)
+    return report
+
+def _scandir(path):
+    """
+    yields (name, full path, is directory) for each entry of a directory, links are not followed
+
+    uses scandir where available, which reads the entry type with the name, and
+    otherwise listdir with an lstat of each entry
+    """
+    if _os_scandir is not None:
+        for entry in _os_scandir(path):
+            yield entry.name, entry.path, entry.is_dir(follow_symlinks=False)
+        return
+    for name in os.listdir(path):
+        full = os.path.join(path,name)
+        yield name, full, stat.S_ISDIR(os.lstat(full).st_mode)
+
+def _tree_size(path):
+    """bytes used by the files below path, or by path itself if it is not a directory"""
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size
+    total = 0
+    for name, full, is_dir in _scandir(path):
+        total += _tree_size(full)
+    return total
+
+def _stray_files(f_dir,listed,prefix=''):
+    """yields (relative path, size) of files below f_dir whose path is not in listed"""
+    for name, full, is_dir in _scandir(f_dir):
+        rel = prefix + name
+        if is_dir:
+            for stray in _stray_files(full,listed,rel + '/'):
+                yield stray
+        elif './' + rel not in listed:
+            yield rel, os.lstat(full).st_size
+
+@phase('garbage')
+def garbage(trash=False):
+    """
+    finds what nothing in the radmind tree needs
+
+    marks every transcript referenced by any command file, including those matching
+    default_k_excludes, then for each transcript with stored files reads the
+    transcript once, marking the files it lists, and sweeps file/ once, finding
+
+        transcripts no command file references
+        file/ directories with no transcript
+        files under file/<load>/ that the transcript of the load does not list
+
+    with trash the items found are moved into the trash, unreferenced transcripts with
+    their stored files, one generation for each.  Pending loads in tmp/ are left alone
+
+    returns a dict {transcripts, file_dirs, stray_files, bytes} of lists of (name, bytes),
+    stray files as (load, path, bytes), and the total bytes found
+    """
+    referenced = Set(_k_reverse())
+    # the reference index leaves out command files matching default_k_excludes,
+    # the transcripts they use are not garbage
+    for k in all_k(exclude=()):
+        if os.path.basename(k) in config.default_k_excludes:
+            try:
+                referenced.update([path for remove, kind, path in _k_entries(k) if kind in ('p','n')])
+            except ValueError:
+                continue
+    _save_k_index()
+    t_dir = os.path.join(config.rad_dir,'transcript')
+    f_top = os.path.join(config.rad_dir,'file')
+    transcripts = Set(all_t())
+    report = {'transcripts':[],'file_dirs':[],'stray_files':[],'bytes':0}
+    for t in sorted(transcripts):
+        if t not in referenced:
+            size = os.path.getsize(os.path.join(t_dir,t))
+            f_dir = os.path.join(f_top,t)
+            if _exists(f_dir):
+                size += _tree_size(f_dir)
+            report['transcripts'].append((t,size))
+    unreferenced = Set([t for t, size in report['transcripts']])
+    def sweep(path,prefix):
+        for name, full, is_dir in _scandir(path):
+            rel = prefix + name
+            if not is_dir:
+                report['stray_files'].append(('',rel,os.lstat(full).st_size))
+            elif not is_load(name):
+                sweep(full,rel + '/')
+            elif rel not in transcripts:
+                report['file_dirs'].append((rel,_tree_size(full)))
+            elif rel in unreferenced:
+                # counted, and trashed, with its transcript
+                continue
+            else:
+                listed = Set()
+                with closing(_open(os.path.join(t_dir,rel))) as src:
+                    for line in src:
+                        if line[0] in ('f','a'):
+                            listed.add(_decode_path(line.split()[1]))
+                for path, size in _stray_files(full,listed):
+                    report['stray_files'].append((rel,path,size))
+    if _exists(f_top):
+        sweep(f_top,'')
+    report['bytes'] = sum([size for name, size in report['transcripts'] + report['file_dirs']]) + \
+        sum([size for t, path, size in report['stray_files']])
+    if trash:
+        for t, size in report['transcripts']:
+            delete(t,update_k=False)
+        for name, size in report['file_dirs']:
+            _trash_paths(name,[os.path.join(f_top,name)],size)
+        strays = {}
+        for t, path, size in report['stray_files']:
+            # files directly in file/ are trashed under their own name
+            strays.setdefault(t or path,[]).append((os.path.join(f_top,t,path),size))
+        for item, files in strays.items():
+            _trash_paths(item,[path for path, size in files],sum([size for path, size in files]))
+    return report
+
 def find_in_K(pattern,K,escaped=True):
     """find a pattern in any descendent transcript
     
@@ -656,10 +3318,14 @@ def find_in_K(pattern,K,escaped=True):
     """
     # this might need a total rethink on the return datastructure
     results = []
+    # a transcript listed by several command files is only scanned once
+    scanned = {}
     for this_k, sub_k, these_t, these_e in walk_K(K):
         found_in = []
         for t in these_t:
-            r = find_in_T(pattern,t,escaped = escaped)
+            if t not in scanned:
+                scanned[t] = find_in_T(pattern,t,escaped = escaped)
+            r = scanned[t]
             if r:
                 found_in.append([t,r])
         if found_in:
@@ -679,45 +3345,145 @@ def parse_K(K,supress_error=False):
     Will preserve precendence order of transcripts
     
     exclude patterns appearing are filtered to be unique
+
+    a command file included from several others (a diamond) is processed each time it
+    is included, as radmind does.  A command file that includes itself, directly or
+    through others, raises RuntimeError unless supress_error, when the loop is skipped
     
     returns a dictionary of lists {command[],transcript[],exclude[]} 
     
     """
-     # see notes in parse_K_walked for why there is so much overlap with this and the walk_K function (this came first)
-    k_file = get_full_path(K)
-    participating_K = [K]
-    transcripts = []
+    participating_K, transcripts, excludes = _parse_K(K,supress_error)
+    return {'command':participating_K.keys(),'transcript':transcripts.keys(),'exclude':list(excludes)}
+
+def _parse_K(K,supress_error=False):
+    """parse_K's ({command: True}, {transcript: 'p' or 'n'}, set of excludes), in precedence order"""
+    participating_K = OrderedDict([(_k_name(K),True)])
+    transcripts = OrderedDict()
     excludes = Set()
-    def k_parser(k_file):
-        with closing(open(k_file)) as src:
-            for line in src:
-                if line == '\n': continue
-                if line[0] == '#': continue
-                fields = line.split()
-                remove = False
-                if fields[0] == '-':
-                    remove = True
-                    del (fields[0])
-                path = fields[1]
-                if fields[0] in ('p','n'):
-                    if path in transcripts:
-                        # delete it first then append
-                        del(transcripts[transcripts.index(path)])
-                    # @@ todo what is the best way to denote negative in this structure without overcomplicating?
-                    # perhaps just a '-' prepended - but that has other meaning in k files?
-                    if not remove:
-                        transcripts.append(path)
+    def k_parser(k,ancestors):
+        for remove, kind, path in _k_entries(k):
+            if kind in ('p','n'):
+                # delete it first then append, to move it to the highest precedence
+                transcripts.pop(path,None)
+                if not remove:
+                    transcripts[path] = kind
+            elif kind == 'k':
+                if path in ancestors:
+                    if supress_error:
+                        continue
+                    # todo custom radmind error exception
+                    raise RuntimeError("%s referenced multiple times in %s, possible loop condition" % (path, K))
+                participating_K[path] = True
+                k_parser(path,ancestors | Set([path]))
+            elif kind == 'x':
+                excludes.add(path)
+    try:
+        k_parser(K,Set([_k_name(K)]))
+    finally:
+        _save_k_index()
+    return participating_K, transcripts, excludes
 
-                elif fields[0] == 'k':
-                    if path in participating_K and not supress_error:
-                        # todo custom radmind error exception
-                        raise RuntimeError("%s referenced multiple times in %s, possible loop condition" % (path, K))
-                    participating_K.append(path)
-                    k_parser(get_full_path(path))
-                elif fields[0] == 'x':
-                    excludes.add(path)
-    k_parser(k_file)
-    return {'command':list(participating_K),'transcript':list(transcripts),'exclude':list(excludes)}
+def _exclude_matcher(patterns):
+    """
+    a match function for paths excluded by any of the x patterns, or None
+
+    patterns are shell wildcards, as fnmatch, compiled into one regular expression that
+    also matches anything below an excluded directory
+    """
+    if not patterns:
+        return None
+    parts = []
+    for pattern in sorted(patterns):
+        r = fnmatch.translate(pattern)
+        # python 2 appends \Z(?ms), later versions wrap the pattern in (?s:...)\Z
+        if r.endswith('\\Z(?ms)'):
+            r = r[:-len('\\Z(?ms)')]
+        elif r.startswith('(?s:') and r.endswith(')\\Z'):
+            r = r[len('(?s:'):-len(')\\Z')]
+        parts.append('(?:%s)' % r)
+    flags = re.S
+    if not _case_sensitive():
+        flags |= re.I
+    return re.compile('(?:%s)(?:/.*)?\\Z' % '|'.join(parts),flags).match
+
+def _resolve(K,stats=None):
+    """resolve_K, counting paths excluded and entries overridden in stats"""
+    participating_K, transcripts, excludes = _parse_K(K)
+    # highest precedence first
+    order = list(reversed(transcripts.items()))
+    match = _exclude_matcher(excludes)
+    for group in _merge_groups([get_full_path(t) for t, kind in order]):
+        key, rank, removed, fields, line = group[0]
+        if stats is not None:
+            stats['overridden'] += len(group) - 1
+        if removed:
+            continue
+        path = _decode_path(fields[1])
+        if match is not None and match(path):
+            if stats is not None:
+                stats['excluded'] += 1
+            continue
+        yield (path,) + order[rank] + (fields,)
+
+def resolve_K(K):
+    """
+    yields (path, transcript, kind, fields) for each path a client of K receives
+
+    the transcripts of K and its descendents are streamed together, in transcript sort
+    order, through a k-way merge holding one line of each.  For each path the entry of
+    the highest precedence transcript wins, a winning '-' line removes the path, and
+    paths matching an x exclude pattern are dropped.  kind is p, or n for a path that
+    comes from a negative transcript
+    """
+    return _resolve(K)
+
+def _view_version(K):
+    """what a resolved view of K depends on, the command files, transcripts and their stamps"""
+    participating_K, transcripts, excludes = _parse_K(K)
+    records = _k_index_entry()[0]
+    version = [_case_sensitive(),sorted(excludes)]
+    for k in participating_K:
+        version.append((k,) + tuple(records[k][:2]))
+    for t, kind in transcripts.items():
+        st = os.stat(get_full_path(t))
+        version.append((t,kind,st.st_mtime,st.st_size))
+    return version
+
+@phase('view')
+def effective_view(K):
+    """
+    totals for what a client of K receives, as resolved by resolve_K
+
+    returns a dict {paths, files, bytes, negative, excluded, overridden, transcripts},
+    bytes being the stored bytes deployed, with each path counted once unlike
+    sum_command.  Files from negative transcripts are counted under negative and not in
+    bytes.  transcripts maps each transcript to the {paths, bytes} it wins.  Results are
+    cached in the radutil cache until a command file or transcript involved changes
+    """
+    k = _k_name(K)
+    version = _view_version(K)
+    views = _load_cache('views',{})
+    if k in views and views[k][0] == version:
+        return views[k][1]
+    stats = {'paths':0,'files':0,'bytes':0,'negative':0,'excluded':0,'overridden':0}
+    winners = OrderedDict()
+    for path, t, kind, fields in _resolve(K,stats):
+        won = winners.setdefault(t,{'paths':0,'bytes':0})
+        won['paths'] += 1
+        stats['paths'] += 1
+        size = _t_size(fields)
+        if fields[0] in ('f','a'):
+            if kind == 'n':
+                stats['negative'] += 1
+                continue
+            stats['files'] += 1
+            stats['bytes'] += size
+            won['bytes'] += size
+    stats['transcripts'] = dict(winners)
+    views[k] = (version,stats)
+    _save_cache('views',views)
+    return stats
 
 def parse_K_walked(K,supress_error=False):
     """
@@ -730,65 +3496,57 @@ def parse_K_walked(K,supress_error=False):
      # keeping the integrity of the transcript order
      # a transcript that appears after a k-in-k can get stomped because the k gets processed after all transcripts
     participating_K = []
-    transcripts = []
+    transcripts = OrderedDict()
     excludes = Set()
     for this_k, sub_k, these_t, these_e in walk_K(K):
         if this_k != K:
             participating_K.append(this_k)
         for t in these_t:
-            if t in transcripts:
-                del(transcripts[transcripts.index(t)])
-            transcripts.append(t)
+            transcripts.pop(t,None)
+            transcripts[t] = True
         excludes.update(these_e)
-    return {'command':list(participating_K),'transcript':list(transcripts),'exclude':list(excludes)}
+    return {'command':list(participating_K),'transcript':transcripts.keys(),'exclude':list(excludes)}
 
 def walk_K(K):
     """
     A generator function modeled on os.walk
     
     yields a tuple of (k name, sub k's,transcripts, excludes) for each K traversed
+
+    each command file is yielded once, even when included from several others.
+    A command file that includes itself, directly or through others, raises RuntimeError
     
     """
-    k_files_to_process = [K]
-    seen_k = []
-    while k_files_to_process:
-        participating_K = []
-        transcripts = []
-        excludes = Set()
-        this_k = k_files_to_process.pop()
-        # print this_k
-        k_file = get_full_path(this_k)
-        with closing(open(k_file)) as src:
-            for line in src:
-                if line == '\n': continue
-                if line[0] == '#': continue
-                fields = line.split()
-                remove = False
-                if fields[0] == '-':
-                    remove = True
-                    del (fields[0])
-                path = fields[1]
-                if fields[0] in ('p','n'):
-                    if path in transcripts:
-                        # delete it first then append
-                        del(transcripts[transcripts.index(path)])
-                    # todo what is the best way to denote negative in this structure without overcomplicating?
-                    # perhaps just a '-' prepended?
+    k_files_to_process = [(K,Set([_k_name(K)]))]
+    seen_k = Set()
+    try:
+        while k_files_to_process:
+            this_k, ancestors = k_files_to_process.pop()
+            name = _k_name(this_k)
+            if name in seen_k:
+                # shared include, already walked
+                continue
+            seen_k.add(name)
+            participating_K = []
+            transcripts = OrderedDict()
+            excludes = Set()
+            for remove, kind, path in _k_entries(this_k):
+                if kind in ('p','n'):
+                    # delete it first then append
+                    transcripts.pop(path,None)
                     if not remove:
-                        transcripts.append(path)
-                elif fields[0] == 'k':
-                    if path in seen_k:
-                        raise RuntimeError("%s referenced multiple times in %s" % (path, K))
-                    else:
-                        seen_k.append(path)
-                        participating_K.append(path)
-                elif fields[0] == 'x':
+                        transcripts[path] = True
+                elif kind == 'k':
+                    if path in ancestors:
+                        raise RuntimeError("%s referenced multiple times in %s, possible loop condition" % (path, K))
+                    participating_K.append(path)
+                elif kind == 'x':
                     excludes.add(path)
-            if len(participating_K) > 0:
-                # print participating_K
-                participating_K.reverse()
-                k_files_to_process.extend(participating_K)
-            yield (this_k,participating_K,transcripts,list(excludes))
+            for path in reversed(participating_K):
+                k_files_to_process.append((path,ancestors | Set([path])))
+            yield (this_k,participating_K,transcripts.keys(),list(excludes))
+    finally:
+        _save_k_index()
             
 if __name__ == '__main__':
     main()